@@ -1,18 +1,36 @@
 from flask import Flask
+from werkzeug.serving import make_server
 from pymongo import MongoClient
+from pymongo.errors import BulkWriteError, PyMongoError
 from bson.objectid import ObjectId
 import threading
+import asyncio
+import signal
 import os
+import io
+import re
+import csv
 import json
+import gzip
+import time
+import atexit
+import hashlib
+import tempfile
+import numpy as np
+from collections import OrderedDict
+from functools import partial
 from dotenv import load_dotenv
-from datetime import datetime, timedelta
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardRemove
+import callback_data as cb
+import tracing
+from datetime import datetime, timedelta, timezone
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardRemove, InputFile
 from telegram.ext import (
     ApplicationBuilder,
     CommandHandler,
     ConversationHandler,
     CallbackQueryHandler,
     MessageHandler,
+    TypeHandler,
     filters,
     CallbackContext,
     ContextTypes,
@@ -24,8 +42,10 @@ load_dotenv()
 import logging
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
+    level=logging.INFO,
+    handlers=tracing.log_handlers()
 )
+tracing.setup()
 #filterwarnings(action="ignore", message=r".*CallbackQueryHandler", category=PTBUserWarning)
 
 # Minimal web server for keep-alive
@@ -35,19 +55,217 @@ app = Flask(__name__)
 def home():
     return "Bot is running!"
 
-def run_web_server():
+@app.route('/metrics')
+def metrics():
+    lines = [
+        f"process_resident_memory_bytes {rss_bytes()}",
+        f"bot_user_data_entries {session_metrics['user_data']}",
+        f"bot_sessions_evicted_total {session_metrics['evicted']}",
+        f"bot_conversation_timeouts_total {session_metrics['timeouts']}",
+        f"bot_draining {shutdown_metrics['draining']}",
+        f"bot_last_drain_seconds {shutdown_metrics['last_drain_seconds']}",
+        f"bot_last_drain_timed_out {shutdown_metrics['last_drain_timed_out']}",
+    ]
+    return "\n".join(lines) + "\n", 200, {'Content-Type': 'text/plain; version=0.0.4'}
+
+def start_web_server():
     # Get PORT from environment variable if available; otherwise, default to 8080
     port = int(os.environ.get("PORT", 8080))
-    app.run(host="0.0.0.0", port=port)
+    server = make_server("0.0.0.0", port, app, threaded=True)
+    # Daemon so a stuck request can't hold the process; serve() shuts it down cleanly
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
 
-client = MongoClient(os.getenv("MONGODB_URI"))
+client = MongoClient(os.getenv("MONGODB_URI"), event_listeners=tracing.mongo_listeners())
 db = client[os.getenv("DB_NAME")]
 appointments = db.appointments
 persistent = db.persistents
 slots_config = db.config
+waitlist = db.waitlist
+holds = db.holds
+rollups = db.rollups
+events = db.events
+# user_id -> tenant of the last booking link a user opened
+users = db.users
+# One document per drained shutdown; the server is gone by the time a drain ends,
+# so the next start reports the last one
+shutdowns = db.shutdowns
+
+def ensure_indexes():
+    # Every query is scoped to one tenant, so tenant leads every index
+    # Waitlist is popped in join order per date; one entry per user and date
+    waitlist.create_index([("tenant", 1), ("date", 1), ("joined_at", 1)])
+    waitlist.create_index([("tenant", 1), ("user_id", 1), ("date", 1)], unique=True)
+    holds.create_index([("tenant", 1), ("start", 1), ("expires_at", 1)])
+    # One rollup document per tenant and calendar date
+    rollups.create_index([("tenant", 1), ("date", 1)], unique=True)
+    appointments.create_index([("tenant", 1), ("start", 1)])
+    appointments.create_index([("series_id", 1)], sparse=True)
+    events.create_index([("tenant", 1), ("_id", 1)])
+    slots_config.create_index([("admin_ids", 1)])
+
+def migrate_default_tenant():
+    """Seed the default tenant from the environment and adopt data created before tenants."""
+    update = {"$setOnInsert": {"days_config": default_days_config}}
+    if ADMIN_CHAT_ID:
+        update["$addToSet"] = {"admin_ids": ADMIN_CHAT_ID}
+    slots_config.update_one({"_id": DEFAULT_TENANT}, update, upsert=True)
+    
+    for collection in (appointments, persistent, waitlist, holds, rollups, events):
+        collection.update_many({"tenant": {"$exists": False}}, {"$set": {"tenant": DEFAULT_TENANT}})
 
-async def get_all_appointments():
-    return appointments.find({})
+class LRUCache:
+    """Bounded mapping that evicts the least recently used key."""
+    
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+    
+    def get(self, key):
+        value = self.data.get(key)
+        if value is not None:
+            self.data.move_to_end(key)
+        return value
+    
+    def set(self, key, value):
+        self.data[key] = value
+        self.data.move_to_end(key)
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+    
+    def pop(self, key):
+        self.data.pop(key, None)
+
+# Tenant documents keyed ('tenant', id) and admin lookups keyed ('admin', user id)
+tenant_cache = LRUCache(int(os.getenv('TENANT_CACHE_SIZE', 256)))
+
+async def get_tenant(tenant):
+    key = ('tenant', tenant)
+    doc = tenant_cache.get(key)
+    if doc is None:
+        doc = slots_config.find_one({"_id": tenant})
+        if not doc:
+            return None
+        tenant_cache.set(key, doc)
+    return doc
+
+async def get_days_config(tenant):
+    doc = await get_tenant(tenant)
+    return doc['days_config'] if doc else None
+
+async def save_days_config(tenant, config):
+    slots_config.update_one({"_id": tenant}, {"$set": {"days_config": config}})
+    tenant_cache.pop(('tenant', tenant))
+
+async def update_days_config(tenant, update):
+    slots_config.update_one({"_id": tenant}, update)
+    tenant_cache.pop(('tenant', tenant))
+
+async def user_tenant(context, user_id):
+    """Return the tenant a user books with, remembered across restarts and idle sweeps."""
+    tenant = context.user_data.get('tenant')
+    if tenant is None:
+        doc = users.find_one({"_id": user_id}, {"tenant": 1})
+        tenant = doc['tenant'] if doc else DEFAULT_TENANT
+        context.user_data['tenant'] = tenant
+    return tenant
+
+async def set_user_tenant(context, user_id, tenant):
+    users.update_one({"_id": user_id}, {"$set": {"tenant": tenant}}, upsert=True)
+    context.user_data['tenant'] = tenant
+
+async def admin_tenant(user_id):
+    """Return the tenant a user administers, or None."""
+    key = ('admin', str(user_id))
+    tenant = tenant_cache.get(key)
+    if tenant is None:
+        doc = slots_config.find_one({"admin_ids": str(user_id)}, {"_id": 1})
+        # Cache misses as '' so regular users don't hit Mongo on every check
+        tenant = doc['_id'] if doc else ''
+        tenant_cache.set(key, tenant)
+    return tenant or None
+
+async def create_tenant(tenant, admin_id):
+    slots_config.update_one(
+        {"_id": tenant},
+        {"$setOnInsert": {"days_config": default_days_config}, "$addToSet": {"admin_ids": str(admin_id)}},
+        upsert=True
+    )
+    tenant_cache.pop(('tenant', tenant))
+    tenant_cache.pop(('admin', str(admin_id)))
+
+class EventLog:
+    """Append-only booking event log, buffered in memory and written in batches."""
+    
+    def __init__(self, collection):
+        self.collection = collection
+        self.buffer = []
+    
+    def record(self, kind, **fields):
+        # _id is assigned now so the log sorts in the order events happened
+        self.buffer.append({'_id': ObjectId(), 'type': kind, 'at': datetime.now().isoformat(), **fields})
+    
+    async def flush(self):
+        if not self.buffer:
+            return 0
+        batch, self.buffer = self.buffer, []
+        try:
+            self.collection.insert_many(batch, ordered=False)
+        except BulkWriteError as e:
+            # Duplicates were written by an earlier, partially failed flush
+            failed = {err['index'] for err in e.details['writeErrors'] if err['code'] != 11000}
+            self.buffer[:0] = [event for i, event in enumerate(batch) if i in failed]
+            logging.error(f"Failed to write {len(failed)} booking events: {e}")
+        except PyMongoError as e:
+            self.buffer[:0] = batch
+            logging.error(f"Failed to write {len(batch)} booking events: {e}")
+        return len(batch)
+
+event_log = EventLog(events)
+
+async def flush_events(context: CallbackContext):
+    await event_log.flush()
+
+async def rebuild_appointments(tenant):
+    """Rebuild a tenant's appointments by replaying the event log."""
+    await event_log.flush()
+    
+    view = {}
+    for event in events.find({
+        "tenant": tenant,
+        "type": {"$in": ["approved", "cancelled"]}
+    }).sort("_id", 1):
+        if event['type'] == 'approved':
+            for appointment in event['appointments']:
+                view[appointment['_id']] = appointment
+        else:
+            view.pop(event['appointment_id'], None)
+    
+    # Written aside first so a failure can't leave the tenant with half a view
+    rebuilt = db[f"appointments_rebuild_{tenant}"]
+    rebuilt.drop()
+    if view:
+        rebuilt.insert_many(list(view.values()))
+    previous = list(appointments.find({"tenant": tenant}))
+    appointments.delete_many({"tenant": tenant})
+    try:
+        if view:
+            appointments.insert_many(rebuilt.find(), ordered=False)
+    except PyMongoError:
+        # Put back what was there before; the rebuilt view stays aside for inspection
+        logging.exception(f"Rebuild of {tenant} failed, restoring {len(previous)} appointments")
+        try:
+            appointments.delete_many({"tenant": tenant})
+            if previous:
+                appointments.insert_many(previous, ordered=False)
+        except PyMongoError:
+            logging.exception(f"Restoring {tenant} failed; the rebuilt view is in {rebuilt.name}")
+        raise
+    rebuilt.drop()
+    return len(view)
+
+async def get_all_appointments(tenant):
+    return appointments.find({"tenant": tenant})
 
 async def get_user_appointments(user_id):
     return appointments.find_one({"user_id": user_id})
@@ -58,34 +276,184 @@ async def get_day_appointments(day):
         "start": {"$gte": datetime.now().isoformat()}
     })
 
-async def delete_appointment(user_id):
-    result = appointments.delete_one({"user_id": user_id})
+async def get_appointment(appointment_id):
+    return appointments.find_one({"_id": appointment_id})
+
+async def delete_appointment(appointment_id):
+    result = appointments.delete_one({"_id": appointment_id})
     return result.deleted_count > 0
 
 async def create_appointment(appointment):
     result = appointments.insert_one(appointment)
     return result.inserted_id  # Return the unique Id
 
-async def get_user_persistent(user_id):
-    return persistent.find_one({"user_id": user_id})
+async def find_conflicts(tenant, occurrences, series_id=None):
+    # One $or query; each branch is an indexed range scan on tenant + start,
+    # bounded below by the occurrence's midnight since bookings never span days
+    query = {"tenant": tenant, "$or": [
+        {"start": {"$gte": o['start'][:10], "$lt": o['end']}, "end": {"$gt": o['start']}}
+        for o in occurrences
+    ]}
+    if series_id:
+        # Rows a failed attempt to create this series left behind are not conflicts
+        query["series_id"] = {"$ne": series_id}
+    return list(appointments.find(query))
+
+async def create_series(bookings, series_id):
+    """Insert every occurrence of a series in one bulk write, or none of them."""
+    # Clear rows left by an earlier attempt whose rollback failed too
+    appointments.delete_many({"series_id": series_id})
+    try:
+        appointments.insert_many(bookings, ordered=True)
+    except PyMongoError:
+        # Roll back whatever landed before the failure, e.g. a dropped connection mid-batch
+        try:
+            appointments.delete_many({"series_id": series_id})
+        except PyMongoError as e:
+            logging.error(f"Could not roll back series {series_id}: {e}")
+        raise
+
+async def get_persistent(request_id):
+    return persistent.find_one({"_id": request_id})
 
-async def delete_persistent(user_id):
-    result = persistent.delete_one({"user_id": user_id})
+async def delete_persistent(request_id):
+    result = persistent.delete_one({"_id": request_id})
     return result.deleted_count > 0
 
+async def update_rollup(booking, **counters):
+    """Fold a booking state change into the rollup document for its date."""
+    start = datetime.fromisoformat(booking['start'])
+    end = datetime.fromisoformat(booking['end'])
+    booked = int((end - start).total_seconds() // 60)
+    
+    inc = dict(counters)
+    if counters.get('approvals'):
+        inc['booked_minutes'] = booked
+    elif counters.get('cancellations'):
+        inc['booked_minutes'] = -booked
+    
+    config = await get_days_config(booking['tenant'])
+    rollups.update_one(
+        {"tenant": booking['tenant'], "date": start.date().isoformat()},
+        {
+            "$inc": inc,
+            "$set": {"day": booking['day'], "available_minutes": available_minutes(config[booking['day']])}
+        },
+        upsert=True
+    )
+
+def backfill_rollups():
+    """Seed rollups from the bookings that existed before rollups were kept.
+    
+    Runs while the collection is empty; after that update_rollup keeps it current.
+    """
+    if rollups.find_one({}, {"_id": 1}):
+        return
+    
+    docs = []
+    days_configs = {}
+    for group in appointments.aggregate([
+        {"$group": {
+            "_id": {"tenant": "$tenant", "date": {"$substrCP": ["$start", 0, 10]}},
+            "day": {"$first": "$day"},
+            "approvals": {"$sum": 1},
+            "booked_ms": {"$sum": {"$subtract": [
+                {"$dateFromString": {"dateString": "$end"}},
+                {"$dateFromString": {"dateString": "$start"}}
+            ]}}
+        }}
+    ]):
+        tenant = group['_id']['tenant']
+        if tenant not in days_configs:
+            doc = slots_config.find_one({"_id": tenant}, {"days_config": 1})
+            days_configs[tenant] = doc['days_config'] if doc else {}
+        config = days_configs[tenant].get(group['day'])
+        docs.append({
+            "tenant": tenant,
+            "date": group['_id']['date'],
+            "day": group['day'],
+            "approvals": group['approvals'],
+            "booked_minutes": int(group['booked_ms'] // 60000),
+            "available_minutes": available_minutes(config) if config else 0
+        })
+    if docs:
+        rollups.insert_many(docs)
+        logging.info(f"Backfilled {len(docs)} rollups from existing appointments")
+
+def iter_appointments(tenant, since=None, until=None):
+    # Cursor is consumed lazily in batches so exports never hold every booking
+    query = {"tenant": tenant}
+    if since:
+        query.setdefault("start", {})["$gte"] = since.isoformat()
+    if until:
+        query.setdefault("start", {})["$lt"] = until.isoformat()
+    yield from appointments.find(query).sort("start", 1).batch_size(EXPORT_BATCH_SIZE)
+
+async def get_rollups(tenant, since):
+    return rollups.find({"tenant": tenant, "date": {"$gte": since.isoformat()}}).sort("date", 1)
+
+async def join_waitlist(entry):
+    # Upsert so tapping "Join waitlist" twice keeps the original place in line
+    waitlist.update_one(
+        {"tenant": entry['tenant'], "user_id": entry['user_id'], "date": entry['date']},
+        {"$setOnInsert": {**entry, "joined_at": datetime.now().isoformat()}},
+        upsert=True
+    )
+
+async def pop_waitlist(tenant, date):
+    return waitlist.find_one_and_delete({"tenant": tenant, "date": date}, sort=[("joined_at", 1)])
+
+async def claim_hold(hold_id, user_id):
+    return holds.find_one_and_delete({
+        "_id": hold_id,
+        "user_id": user_id,
+        "expires_at": {"$gt": datetime.now().isoformat()}
+    })
+
+async def release_hold(hold_id):
+    return holds.find_one_and_delete({"_id": hold_id})
+
 # Configuration
 TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
 ADMIN_CHAT_ID = os.getenv('ADMIN_CHAT_ID')
 # Configuration
 DAYS_CONFIG_FILE = 'days_config.json'
 APPOINTMENTS_FILE = 'appointments.json'
-
-# Load days configuration
+# How long a waitlisted user has to claim a freed slot before it moves on
+WAITLIST_HOLD_MINUTES = int(os.getenv('WAITLIST_HOLD_MINUTES', 10))
+# Mongo cursor batch size and in-memory limit before exports spill to disk
+EXPORT_BATCH_SIZE = 500
+EXPORT_SPOOL_BYTES = 1024 * 1024
+EXPORT_FIELDS = ['name', 'contact', 'day', 'start', 'end', 'status', 'user_id']
+# How often buffered booking events are written to Mongo
+EVENT_FLUSH_SECONDS = int(os.getenv('EVENT_FLUSH_SECONDS', 5))
+# Abandoned conversations end after this many seconds
+CONVERSATION_TIMEOUT = int(os.getenv('CONVERSATION_TIMEOUT', 15 * 60))
+# user_data of users idle this long is dropped; above USER_DATA_MAX resident users the least
+# recently seen go first, but never those seen within CONVERSATION_TIMEOUT
+SESSION_IDLE_SECONDS = int(os.getenv('SESSION_IDLE_SECONDS', 7 * 24 * 3600))
+USER_DATA_MAX = int(os.getenv('USER_DATA_MAX', 10000))
+SESSION_SWEEP_SECONDS = int(os.getenv('SESSION_SWEEP_SECONDS', 5 * 60))
+# In-flight updates get this long to finish on SIGTERM, within the usual 30 s grace period
+DRAIN_TIMEOUT = float(os.getenv('DRAIN_TIMEOUT', 25))
+# Most recent per-date lines shown by /stats
+STATS_DATE_LINES = 40
+# Longest /stats window; each date in it is walked
+STATS_MAX_DAYS = 366
+# Tenant served when /start has no deep-link payload; ADMIN_CHAT_ID administers it
+DEFAULT_TENANT = os.getenv('DEFAULT_TENANT', 'default')
+# Allowed characters of a Telegram /start payload
+TENANT_ID = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+# Opt-in log of anonymized incoming updates for replay.py, e.g. updates.jsonl.gz
+RECORD_UPDATES_FILE = os.getenv('RECORD_UPDATES')
+RECORD_SALT = os.getenv('RECORD_SALT', '')
+
+# Load days configuration, used to seed the default tenant and new tenants
 try:
     with open(DAYS_CONFIG_FILE, 'r') as f:
-        days_config = json.load(f)
+        default_days_config = json.load(f)
 except FileNotFoundError:
-    days_config = {
+    default_days_config = {
         'wednesday': {
             'active': True,
             'start': "11:00",
@@ -104,31 +472,52 @@ except FileNotFoundError:
         }
     }
 
+def available_minutes(config):
+    start = datetime.strptime(config['start'], "%H:%M")
+    end = datetime.strptime(config['end'], "%H:%M")
+    minutes = (end - start).total_seconds() // 60
+    for b in config['breaks']:
+        minutes -= (datetime.strptime(b['end'], "%H:%M") - datetime.strptime(b['start'], "%H:%M")).total_seconds() // 60
+    return int(max(minutes, 0))
+
+# Index of each day in callback data, matching datetime.weekday()
+WEEKDAYS = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday']
+
+def day_buttons(tag, days_config):
+    return [[
+        InlineKeyboardButton(day.capitalize(), callback_data=cb.encode(tag, WEEKDAYS.index(day)))
+        for day in WEEKDAYS if day in days_config
+    ]]
+
+def callback_day(query):
+    _, (weekday,) = cb.decode(query.data)
+    return WEEKDAYS[weekday]
+
 # Modified appointments structure
 #appointments = {}  # Format: {user_id: {day: str, time: datetime, name: str, contact: str}}
 
 # New conversation states
 CHOOSE_DAY, GET_NAME, GET_CONTACT, CHOOSE_TIME = range(4)
+CHOOSE_REPEAT = 17
+# Weekly repeat choices offered after picking a slot
+REPEAT_WEEKS = [1, 4, 8, 12]
 ADMIN_APPROVAL, REJECTION_REASON = range(4, 6)
 
 # Admin commands
 async def toggle_day(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if str(update.effective_user.id) != ADMIN_CHAT_ID:
+    tenant = await admin_tenant(update.effective_user.id)
+    if not tenant:
         await update.message.reply_text("❌ Admin only command")
         return
 
-    buttons = [
-        [
-            InlineKeyboardButton(
-                f"Wednesday {'✅' if days_config['wednesday']['active'] else '❌'}",
-                callback_data='toggle_wednesday'
-            ),
-            InlineKeyboardButton(
-                f"Friday {'✅' if days_config['friday']['active'] else '❌'}",
-                callback_data='toggle_friday'
-            )
-        ]
-    ]
+    days_config = await get_days_config(tenant)
+    buttons = [[
+        InlineKeyboardButton(
+            f"{day.capitalize()} {'✅' if days_config[day]['active'] else '❌'}",
+            callback_data=cb.encode(cb.TOGGLE_DAY, WEEKDAYS.index(day))
+        )
+        for day in WEEKDAYS if day in days_config
+    ]]
     await update.message.reply_text(
         "Toggle booking days:",
         reply_markup=InlineKeyboardMarkup(buttons)
@@ -136,11 +525,15 @@ async def toggle_day(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def handle_toggle(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    day = query.data.split('_')[1]
+    tenant = await admin_tenant(query.from_user.id)
+    if not tenant:
+        await query.answer("❌ Admin only command")
+        return
+    day = callback_day(query)
     
+    days_config = await get_days_config(tenant)
     days_config[day]['active'] = not days_config[day]['active']
-    with open(DAYS_CONFIG_FILE, 'w') as f:
-        json.dump(days_config, f)
+    await save_days_config(tenant, days_config)
     
     await query.edit_message_text(
         text=f"✅ {day.capitalize()} availability toggled {'ON' if days_config[day]['active'] else 'OFF'}"
@@ -194,28 +587,24 @@ SET_DURATION_DAY, SET_DURATION_VALUE = range(8, 10)
 ADD_BREAK_DAY, ADD_BREAK_START, ADD_BREAK_END = range(10, 13)
 REMOVE_BREAK_DAY, SELECT_BREAK_TO_REMOVE = range(13, 15)
 TOGGLE_PARTIAL_DAY, SET_PARTIAL_MODE = range(15, 17)
+CONFIRM_CHANGE = 18
 
 # Add these admin command handlers
 async def set_duration(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if str(update.effective_user.id) != ADMIN_CHAT_ID:
+    tenant = await admin_tenant(update.effective_user.id)
+    if not tenant:
         await update.message.reply_text("❌ Admin only command")
         return
 
-    buttons = [
-        [
-            InlineKeyboardButton("Wednesday", callback_data="duration_wednesday"),
-            InlineKeyboardButton("Friday", callback_data="duration_friday")
-        ]
-    ]
     await update.message.reply_text(
         "Select day to set slot duration:",
-        reply_markup=InlineKeyboardMarkup(buttons)
+        reply_markup=InlineKeyboardMarkup(day_buttons(cb.DURATION_DAY, await get_days_config(tenant)))
     )
     return SET_DURATION_DAY
 
 async def set_duration_day(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    context.user_data['duration_day'] = query.data.split('_')[1]
+    context.user_data['duration_day'] = callback_day(query)
     await query.edit_message_text("Enter new slot duration in minutes:")
     return SET_DURATION_VALUE
 
@@ -226,39 +615,34 @@ async def set_duration_value(update: Update, context: ContextTypes.DEFAULT_TYPE)
             raise ValueError
         
         day = context.user_data['duration_day']
-        days_config[day]['duration'] = duration
+        tenant = await admin_tenant(update.effective_user.id)
+        days_config = await get_days_config(tenant)
+        candidate = dict(days_config[day], duration=duration)
         
-        with open(DAYS_CONFIG_FILE, 'w') as f:
-            json.dump(days_config, f)
-        
-        await update.message.reply_text(
+        return await propose_change(
+            update.message.reply_text, context, tenant, day, candidate,
+            {"$set": {f"days_config.{day}.duration": duration}},
             f"✅ {day.capitalize()} slot duration set to {duration} minutes"
         )
-        return ConversationHandler.END
     except ValueError:
         await update.message.reply_text("❌ Invalid duration. Please enter a positive integer")
         return SET_DURATION_VALUE
 
 async def add_break(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if str(update.effective_user.id) != ADMIN_CHAT_ID:
+    tenant = await admin_tenant(update.effective_user.id)
+    if not tenant:
         await update.message.reply_text("❌ Admin only command")
         return
 
-    buttons = [
-        [
-            InlineKeyboardButton("Wednesday", callback_data="break_wednesday"),
-            InlineKeyboardButton("Friday", callback_data="break_friday")
-        ]
-    ]
     await update.message.reply_text(
         "Select day to add break:",
-        reply_markup=InlineKeyboardMarkup(buttons)
+        reply_markup=InlineKeyboardMarkup(day_buttons(cb.BREAK_DAY, await get_days_config(tenant)))
     )
     return ADD_BREAK_DAY
 
 async def add_break_day(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    context.user_data['break_day'] = query.data.split('_')[1]
+    context.user_data['break_day'] = callback_day(query)
     await query.edit_message_text("Enter break start time (HH:MM):")
     return ADD_BREAK_START
 
@@ -281,37 +665,33 @@ async def add_break_end(update: Update, context: ContextTypes.DEFAULT_TYPE):
             raise ValueError("End time must be after start time")
         
         day = context.user_data['break_day']
-        days_config[day]['breaks'].append({
+        tenant = await admin_tenant(update.effective_user.id)
+        days_config = await get_days_config(tenant)
+        new_break = {
             'start': context.user_data['break_start'],
             'end': update.message.text
-        })
-        
-        with open(DAYS_CONFIG_FILE, 'w') as f:
-            json.dump(days_config, f)
+        }
+        candidate = dict(days_config[day], breaks=days_config[day]['breaks'] + [new_break])
         
-        await update.message.reply_text(
+        return await propose_change(
+            update.message.reply_text, context, tenant, day, candidate,
+            {"$push": {f"days_config.{day}.breaks": new_break}},
             f"✅ Break added to {day.capitalize()}: "
             f"{context.user_data['break_start']} - {update.message.text}"
         )
-        return ConversationHandler.END
     except ValueError as e:
         await update.message.reply_text(f"❌ Error: {str(e)}")
         return ADD_BREAK_END
 
 async def remove_break(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if str(update.effective_user.id) != ADMIN_CHAT_ID:
+    tenant = await admin_tenant(update.effective_user.id)
+    if not tenant:
         await update.message.reply_text("❌ Admin only command")
         return
     
-    buttons = [
-        [
-            InlineKeyboardButton("Wednesday", callback_data="removebreak_wednesday"),
-            InlineKeyboardButton("Friday", callback_data="removebreak_friday")
-        ]
-    ]
     await update.message.reply_text(
         "Select day to remove break:",
-        reply_markup=InlineKeyboardMarkup(buttons)
+        reply_markup=InlineKeyboardMarkup(day_buttons(cb.REMOVE_BREAK_DAY, await get_days_config(tenant)))
     )
     return REMOVE_BREAK_DAY
 
@@ -319,25 +699,26 @@ async def remove_break_day(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     
-    day = query.data.split('_')[1]
+    day = callback_day(query)
     context.user_data['remove_break_day'] = day
+    days_config = await get_days_config(await admin_tenant(query.from_user.id))
     breaks = days_config[day]['breaks']
     
     if not breaks:
         await query.edit_message_text(
             f"❌ No breaks configured for {day.capitalize()}"
         )
-        return ConversationHandler.END
+        return end_session(context, REMOVE_BREAK_KEYS)
     
     # Show list of breaks to remove
     buttons = [
         [InlineKeyboardButton(
             f"{b['start']} - {b['end']}", 
-            callback_data=f"removebreak_{index}"
+            callback_data=cb.encode(cb.REMOVE_BREAK, index)
         )] 
         for index, b in enumerate(breaks)
     ]
-    buttons.append([InlineKeyboardButton("Remove All", callback_data="removebreak_all")])
+    buttons.append([InlineKeyboardButton("Remove All", callback_data=cb.encode(cb.REMOVE_ALL_BREAKS))])
     
     await query.edit_message_text(
         f"Select break to remove from {day.capitalize()}:",
@@ -350,53 +731,51 @@ async def handle_break_removal(update: Update, context: ContextTypes.DEFAULT_TYP
     await query.answer()
     
     day = context.user_data['remove_break_day']
-    break_data = query.data.split('_')[1]
+    tag, fields = cb.decode(query.data)
+    tenant = await admin_tenant(query.from_user.id)
+    days_config = await get_days_config(tenant)
     
     try:
-        if break_data == "all":
+        if tag == cb.REMOVE_ALL_BREAKS:
             days_config[day]['breaks'] = []
             message = "All breaks removed"
         else:
-            index = int(break_data)
+            index, = fields
             removed_break = days_config[day]['breaks'].pop(index)
             message = f"Removed break {removed_break['start']} - {removed_break['end']}"
         
-        with open(DAYS_CONFIG_FILE, 'w') as f:
-            json.dump(days_config, f)
+        await save_days_config(tenant, days_config)
             
         await query.edit_message_text(f"✅ {message} from {day.capitalize()}")
         
     except (IndexError, ValueError) as e:
         await query.edit_message_text(f"❌ Error: Invalid break selection")
     finally:
-        return ConversationHandler.END
+        return end_session(context, REMOVE_BREAK_KEYS)
 
 async def toggle_partial_slots(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if str(update.effective_user.id) != ADMIN_CHAT_ID:
+    tenant = await admin_tenant(update.effective_user.id)
+    if not tenant:
         await update.message.reply_text("❌ Admin only command")
         return
 
-    buttons = [
-        [
-            InlineKeyboardButton("Wednesday", callback_data="partial_wednesday"),
-            InlineKeyboardButton("Friday", callback_data="partial_friday")
-        ]
-    ]
     await update.message.reply_text(
         "Select day to manage partial slots:",
-        reply_markup=InlineKeyboardMarkup(buttons)
+        reply_markup=InlineKeyboardMarkup(day_buttons(cb.PARTIAL_DAY, await get_days_config(tenant)))
     )
     return TOGGLE_PARTIAL_DAY
 
 async def set_partial_mode(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    day = query.data.split('_')[1]
+    day = callback_day(query)
+    days_config = await get_days_config(await admin_tenant(query.from_user.id))
     current_status = days_config[day]['allow_partial_slots']
+    weekday = WEEKDAYS.index(day)
     
     buttons = [
         [
-            InlineKeyboardButton(f"Enable {'✅' if current_status else ' '}", callback_data=f"partialenable_{day}"),
-            InlineKeyboardButton(f"Disable {'✅' if not current_status else ' '}", callback_data=f"partialdisable_{day}")
+            InlineKeyboardButton(f"Enable {'✅' if current_status else ' '}", callback_data=cb.encode(cb.PARTIAL_MODE, weekday, 1)),
+            InlineKeyboardButton(f"Disable {'✅' if not current_status else ' '}", callback_data=cb.encode(cb.PARTIAL_MODE, weekday, 0))
         ]
     ]
     
@@ -409,25 +788,152 @@ async def set_partial_mode(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def handle_partial_toggle(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    action, day = query.data.split('_')
+    _, (weekday, enabled) = cb.decode(query.data)
+    day = WEEKDAYS[weekday]
     
-    days_config[day]['allow_partial_slots'] = (action == 'partialenable')
+    tenant = await admin_tenant(query.from_user.id)
+    days_config = await get_days_config(tenant)
+    candidate = dict(days_config[day], allow_partial_slots=bool(enabled))
     
-    with open(DAYS_CONFIG_FILE, 'w') as f:
-        json.dump(days_config, f)
+    status = "enabled" if enabled else "disabled"
+    return await propose_change(
+        query.edit_message_text, context, tenant, day, candidate,
+        {"$set": {f"days_config.{day}.allow_partial_slots": bool(enabled)}},
+        f"✅ Partial slots {status} for {day.capitalize()}"
+    )
+
+# Schedule preview
+PREVIEW_WEEKS = 12
+# Conflicting bookings listed in a preview; the rest are only counted
+PREVIEW_CONFLICTS = 20
+
+def hhmm_minutes(text):
+    time_of_day = datetime.strptime(text, "%H:%M")
+    return time_of_day.hour * 60 + time_of_day.minute
+
+def slot_offsets(config):
+    """Start and end of each bookable slot of a day config, in minutes after midnight.
     
-    status = "enabled" if days_config[day]['allow_partial_slots'] else "disabled"
-    await query.edit_message_text(f"✅ Partial slots {status} for {day.capitalize()}")
-    return ConversationHandler.END
+    Shared by generate_slots and schedule_preview so the preview counts the slots users see.
+    """
+    close = hhmm_minutes(config['end'])
+    breaks = sorted((hhmm_minutes(b['start']), hhmm_minutes(b['end'])) for b in config['breaks'])
+    duration = config['duration']
+    
+    starts, ends = [], []
+    current = hhmm_minutes(config['start'])
+    while current < close:
+        break_end = next((end for start, end in breaks if start <= current < end), None)
+        if break_end is not None:
+            current = break_end
+            continue
+        
+        if current + duration <= close:
+            starts.append(current)
+            ends.append(current + duration)
+        elif config['allow_partial_slots']:
+            starts.append(current)
+            ends.append(close)
+        current += duration
+    return np.array(starts, dtype='timedelta64[m]'), np.array(ends, dtype='timedelta64[m]')
+
+def schedule_preview(tenant, day, config, weeks=PREVIEW_WEEKS):
+    """Return free/total slots for each upcoming date and the bookings ``config`` would break.
+    
+    Every slot of every date is checked against all upcoming bookings in one pass.
+    """
+    first = next_occurrence(day).date()
+    dates = np.datetime64(first, 'm') + np.arange(weeks) * np.timedelta64(7, 'D')
+    starts, ends = slot_offsets(config)
+    # weeks x slots
+    slot_starts = dates[:, None] + starts
+    slot_ends = dates[:, None] + ends
+    
+    bookings = list(appointments.find(
+        {
+            "tenant": tenant,
+            "day": day,
+            "start": {"$gte": first.isoformat(), "$lt": (first + timedelta(weeks=weeks)).isoformat()}
+        },
+        {"name": 1, "start": 1, "end": 1}
+    ))
+    booking_starts = np.array([b['start'] for b in bookings], dtype='datetime64[s]').astype('datetime64[m]')
+    booking_ends = np.array([b['end'] for b in bookings], dtype='datetime64[s]').astype('datetime64[m]')
+    
+    # Bookings overlapping [s, e) are those starting before e, minus those
+    # already over by s; the second set is a subset of the first
+    overlapping = (np.searchsorted(np.sort(booking_starts), slot_ends, side='left') -
+                   np.searchsorted(np.sort(booking_ends), slot_starts, side='right'))
+    free = (overlapping == 0).sum(axis=1)
+    
+    # A booking conflicts if it sticks out of opening hours or into a break
+    midnight = booking_starts.astype('datetime64[D]')
+    start_minutes = (booking_starts - midnight).astype(np.int64)
+    end_minutes = (booking_ends - midnight).astype(np.int64)
+    conflict = (start_minutes < hhmm_minutes(config['start'])) | (end_minutes > hhmm_minutes(config['end']))
+    if config['breaks']:
+        break_starts = np.array([hhmm_minutes(b['start']) for b in config['breaks']])
+        break_ends = np.array([hhmm_minutes(b['end']) for b in config['breaks']])
+        conflict |= ((start_minutes[:, None] < break_ends) & (end_minutes[:, None] > break_starts)).any(axis=1)
+    
+    rows = list(zip(dates.astype('datetime64[D]').tolist(), free.tolist(), [len(starts)] * weeks))
+    conflicts = sorted((bookings[i] for i in np.flatnonzero(conflict)), key=lambda b: b['start'])
+    return rows, conflicts
+
+async def propose_change(reply, context, tenant, day, candidate, update, done_message):
+    """Show the schedule preview for a candidate day config and ask to apply ``update``,
+    the Mongo update that turns the current config into ``candidate``.
+    """
+    rows, conflicts = schedule_preview(tenant, day, candidate)
+    context.user_data['pending_change'] = {'update': update, 'message': done_message}
+    
+    lines = [f"📋 {day.capitalize()} over the next {len(rows)} weeks (free/total slots):"]
+    lines += [f"{date.strftime('%d/%m')}: {free}/{total}" for date, free, total in rows]
+    if conflicts:
+        lines.append(f"\n⚠️ {len(conflicts)} bookings conflict with the new schedule:")
+        for booking in conflicts[:PREVIEW_CONFLICTS]:
+            start = datetime.fromisoformat(booking['start'])
+            lines.append(f"• {booking['name']} - {start.strftime('%d/%m %I:%M %p')}")
+        if len(conflicts) > PREVIEW_CONFLICTS:
+            lines.append(f"…and {len(conflicts) - PREVIEW_CONFLICTS} more")
+    else:
+        lines.append("\n✅ No existing bookings conflict")
+    
+    await reply(
+        "\n".join(lines) + "\n\nApply this change?",
+        reply_markup=InlineKeyboardMarkup([[
+            InlineKeyboardButton("✅ Apply", callback_data=cb.encode(cb.CONFIRM_CHANGE, 1)),
+            InlineKeyboardButton("❌ Discard", callback_data=cb.encode(cb.CONFIRM_CHANGE, 0))
+        ]])
+    )
+    return CONFIRM_CHANGE
+
+async def confirm_change(update: Update, context: ContextTypes.DEFAULT_TYPE, keys):
+    query = update.callback_query
+    await query.answer()
+    _, (apply,) = cb.decode(query.data)
+    change = context.user_data.get('pending_change')
+    
+    if not change:
+        await query.edit_message_text("❌ This change has expired")
+    elif apply:
+        # Only the previewed field is written, other settings may have changed since
+        tenant = await admin_tenant(query.from_user.id)
+        await update_days_config(tenant, change['update'])
+        await query.edit_message_text(change['message'])
+    else:
+        await query.edit_message_text("❌ Change discarded")
+    return end_session(context, keys)
 
 
 # Add to your existing code
 async def admin_cancel_booking(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if str(update.effective_user.id) != ADMIN_CHAT_ID:
+    tenant = await admin_tenant(update.effective_user.id)
+    if not tenant:
         await update.message.reply_text("❌ Admin only command")
         return
-    all_appointments = await get_all_appointments()
-    count =  appointments.count_documents({})
+    all_appointments = await get_all_appointments(tenant)
+    count =  appointments.count_documents({"tenant": tenant})
     if count == 0:
         await update.message.reply_text("No active bookings")
         return
@@ -438,9 +944,11 @@ async def admin_cancel_booking(update: Update, context: ContextTypes.DEFAULT_TYP
         end_time = datetime.fromisoformat(booking['end']).strftime("%I:%M %p").lstrip('0')
         btn_text = (f"{booking['name']} - {start_time}-{end_time} "
                    f"({booking['contact']})")
-        buttons.append([InlineKeyboardButton(btn_text, callback_data=f"admincancel_{booking['user_id']}")])
+        buttons.append([InlineKeyboardButton(
+            btn_text, callback_data=cb.encode(cb.ADMIN_CANCEL, cb.oid_to_int(booking['_id']))
+        )])
     
-    buttons.append([InlineKeyboardButton("Cancel All", callback_data="admincancel_all")])
+    buttons.append([InlineKeyboardButton("Cancel All", callback_data=cb.encode(cb.ADMIN_CANCEL_ALL))])
     
     await update.message.reply_text(
         "Active bookings:\n\n" + 
@@ -453,10 +961,15 @@ async def handle_admin_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE
     query = update.callback_query
     await query.answer()
     
-    action, _, data = query.data.partition('_')
-    all_appointments = await get_all_appointments()
+    tenant = await admin_tenant(query.from_user.id)
+    if not tenant:
+        await query.edit_message_text("❌ Admin only command")
+        return ConversationHandler.END
+    
+    tag, fields = cb.decode(query.data)
     
-    if data == "all":
+    if tag == cb.ADMIN_CANCEL_ALL:
+        all_appointments = await get_all_appointments(tenant)
         # Cancel all bookings
         cancelled = []
         for booking in all_appointments:
@@ -476,7 +989,11 @@ async def handle_admin_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE
                 await query.edit_message_text(f"❌ Error notifying user: {str(e)}")
             
             cancelled.append(booking['user_id'])
-            result = await delete_appointment(booking['user_id'])
+            result = await delete_appointment(booking['_id'])
+            event_log.record('cancelled', tenant=tenant, appointment_id=booking['_id'],
+                             user_id=booking['user_id'], by='admin')
+            await update_rollup(booking, cancellations=1)
+            await offer_freed_slot(context, booking)
         
         
         
@@ -484,12 +1001,12 @@ async def handle_admin_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE
         return ConversationHandler.END
     
     try:
-        user_id = int(data)
-        booking = await get_user_appointments(user_id)
+        booking = await get_appointment(cb.int_to_oid(fields[0]))
         
-        if not booking:
+        if not booking or booking['tenant'] != tenant:
             await query.edit_message_text("❌ Booking not found")
             return ConversationHandler.END
+        user_id = booking['user_id']
         
         # Remove reminders
         jobs = context.job_queue.get_jobs_by_name(str(booking['user_id']))
@@ -506,8 +1023,11 @@ async def handle_admin_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE
         except Exception as e:
             await query.edit_message_text(f"❌ Error notifying user: {str(e)}")
         
-        # Remove booking
-        result = await delete_appointment(booking['user_id'])
+        # Remove booking and hand the slot to the waitlist
+        result = await delete_appointment(booking['_id'])
+        event_log.record('cancelled', tenant=tenant, appointment_id=booking['_id'], user_id=user_id, by='admin')
+        await update_rollup(booking, cancellations=1)
+        await offer_freed_slot(context, booking)
         
         
         await query.edit_message_text("✅ Booking cancelled successfully")
@@ -517,17 +1037,219 @@ async def handle_admin_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE
     
     return ConversationHandler.END
 
+async def rebuild_appointments_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    tenant = await admin_tenant(update.effective_user.id)
+    if not tenant:
+        await update.message.reply_text("❌ Admin only command")
+        return
+    
+    if context.args != ['confirm']:
+        await update.message.reply_text(
+            "⚠️ This replaces all appointments with the ones rebuilt from the event log. "
+            "Bookings approved before event logging started will be lost.\n\n"
+            "Send /rebuild_appointments confirm to continue."
+        )
+        return
+    
+    before = appointments.count_documents({"tenant": tenant})
+    try:
+        count = await rebuild_appointments(tenant)
+    except PyMongoError:
+        await update.message.reply_text("❌ Rebuild failed, see the logs before retrying")
+        return
+    await update.message.reply_text(f"✅ Rebuilt {count} appointments from the event log (was {before})")
+
+async def add_tenant(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Only the operator (ADMIN_CHAT_ID) can onboard providers
+    if str(update.effective_user.id) != ADMIN_CHAT_ID:
+        await update.message.reply_text("❌ Admin only command")
+        return
+    
+    args = context.args or []
+    if len(args) != 2 or not TENANT_ID.match(args[0]) or not args[1].lstrip('-').isdigit():
+        await update.message.reply_text("❌ Usage: /add_tenant <tenant id> <admin chat id>")
+        return
+    
+    tenant, admin_id = args
+    if (await admin_tenant(admin_id)) not in (None, tenant):
+        await update.message.reply_text("❌ That chat already administers another tenant")
+        return
+    
+    await create_tenant(tenant, admin_id)
+    await update.message.reply_text(
+        f"✅ Tenant {tenant} is ready, administered by {admin_id}.\n"
+        f"Booking link: https://t.me/{context.bot.username}?start={tenant}"
+    )
+
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    tenant = await admin_tenant(update.effective_user.id)
+    if not tenant:
+        await update.message.reply_text("❌ Admin only command")
+        return
+    
+    try:
+        days = int(context.args[0]) if context.args else 90
+        if not 0 < days <= STATS_MAX_DAYS:
+            raise ValueError
+    except ValueError:
+        await update.message.reply_text(f"❌ Usage: /stats [days], at most {STATS_MAX_DAYS}")
+        return
+    
+    since = datetime.today().date() - timedelta(days=days)
+    by_date = {rollup['date']: rollup for rollup in await get_rollups(tenant, since)}
+    if not by_date:
+        await update.message.reply_text(f"No booking activity in the last {days} days")
+        return
+    
+    # Dates without activity have no rollup but were still open, per the tenant's config
+    days_config = await get_days_config(tenant)
+    last = max(datetime.today().date(), datetime.fromisoformat(max(by_date)).date())
+    totals = {}
+    lines = []
+    date = since
+    while date <= last:
+        rollup = by_date.get(date.isoformat())
+        day_name = WEEKDAYS[date.weekday()]
+        if rollup is None:
+            if day_name not in days_config or not days_config[day_name]['active']:
+                date += timedelta(days=1)
+                continue
+            rollup = {'day': day_name, 'available_minutes': available_minutes(days_config[day_name])}
+        
+        day = totals.setdefault(rollup['day'], {
+            'dates': 0, 'booked_minutes': 0, 'available_minutes': 0,
+            'approvals': 0, 'rejections': 0, 'cancellations': 0
+        })
+        day['dates'] += 1
+        for key in ('booked_minutes', 'available_minutes', 'approvals', 'rejections', 'cancellations'):
+            day[key] += rollup.get(key, 0)
+        
+        if date.isoformat() in by_date:
+            available = rollup.get('available_minutes', 0)
+            usage = rollup.get('booked_minutes', 0) / available * 100 if available else 0
+            lines.append(f"{date.strftime('%a %d/%m')}: {rollup.get('booked_minutes', 0)}/{available} min ({usage:.0f}%)")
+        date += timedelta(days=1)
+    
+    # Keep the reply under Telegram's message size limit
+    if len(lines) > STATS_DATE_LINES:
+        lines = [f"…{len(lines) - STATS_DATE_LINES} earlier dates omitted"] + lines[-STATS_DATE_LINES:]
+    
+    summary = []
+    for day, t in totals.items():
+        usage = t['booked_minutes'] / t['available_minutes'] * 100 if t['available_minutes'] else 0
+        summary.append(
+            f"{day.capitalize()}: {t['booked_minutes'] / 60:.1f}/{t['available_minutes'] / 60:.1f} h "
+            f"booked ({usage:.0f}%) over {t['dates']} dates\n"
+            f"  ✅ {t['approvals']} approved · ❌ {t['rejections']} rejected · "
+            f"🚫 {t['cancellations']} cancelled"
+        )
+    
+    await update.message.reply_text(
+        f"📊 Stats since {since.strftime('%d/%m/%Y')}\n\n" +
+        "\n".join(summary) + "\n\n" +
+        "\n".join(lines)
+    )
+def csv_lines(bookings):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    
+    writer.writerow(EXPORT_FIELDS)
+    yield buffer.getvalue()
+    for booking in bookings:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerow([booking.get(field, '') for field in EXPORT_FIELDS])
+        yield buffer.getvalue()
+
+def ics_escape(text):
+    return (str(text).replace('\\', '\\\\').replace(';', '\\;')
+            .replace(',', '\\,').replace('\n', '\\n'))
+
+def ics_lines(bookings):
+    stamp = datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+    yield "BEGIN:VCALENDAR\r\nVERSION:2.0\r\nPRODID:-//telegram-booking-bot//EN\r\n"
+    for booking in bookings:
+        start = datetime.fromisoformat(booking['start']).strftime('%Y%m%dT%H%M%S')
+        end = datetime.fromisoformat(booking['end']).strftime('%Y%m%dT%H%M%S')
+        yield (
+            "BEGIN:VEVENT\r\n"
+            f"UID:{booking['_id']}@telegram-booking-bot\r\n"
+            f"DTSTAMP:{stamp}\r\n"
+            f"DTSTART:{start}\r\n"
+            f"DTEND:{end}\r\n"
+            f"SUMMARY:{ics_escape(booking['name'])}\r\n"
+            f"DESCRIPTION:{ics_escape(booking['contact'])}\r\n"
+            "END:VEVENT\r\n"
+        )
+    yield "END:VCALENDAR\r\n"
+
+def write_export(export, lines):
+    count = 0
+    for line in lines:
+        export.write(line.encode('utf-8'))
+        count += 1
+    return count
+
+async def export_bookings(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    tenant = await admin_tenant(update.effective_user.id)
+    if not tenant:
+        await update.message.reply_text("❌ Admin only command")
+        return
+    
+    args = list(context.args or [])
+    fmt = args.pop(0).lower() if args else 'csv'
+    try:
+        if fmt not in ('csv', 'ics') or len(args) > 2:
+            raise ValueError
+        since = datetime.strptime(args[0], "%Y-%m-%d") if len(args) > 0 else None
+        # The end date is inclusive
+        until = datetime.strptime(args[1], "%Y-%m-%d") + timedelta(days=1) if len(args) > 1 else None
+    except ValueError:
+        await update.message.reply_text(
+            "❌ Usage: /export [csv|ics] [from YYYY-MM-DD] [to YYYY-MM-DD]"
+        )
+        return
+    
+    lines = csv_lines if fmt == 'csv' else ics_lines
+    with tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_BYTES) as export:
+        # The cursor is synchronous; keep large exports off the event loop
+        count = await asyncio.to_thread(write_export, export, lines(iter_appointments(tenant, since, until)))
+        
+        # Header/footer lines are not bookings
+        count -= 1 if fmt == 'csv' else 2
+        if count == 0:
+            await update.message.reply_text("No bookings in that range")
+            return
+        
+        export.seek(0)
+        # Passed unread so the upload streams it; an in-memory spool also has no name to guess from
+        await update.message.reply_document(
+            document=InputFile(export, filename=f"bookings.{fmt}", read_file_handle=False),
+            caption=f"📤 {count} bookings"
+        )
 
 # Modified booking flow
 async def start(update: Update, context: CallbackContext):
-    active_days = [day for day, config in days_config.items() if config['active']]
+    # Deep links (t.me/<bot>?start=<tenant>) pick the provider to book with
+    if context.args:
+        tenant = context.args[0]
+        if not TENANT_ID.match(tenant) or not await get_tenant(tenant):
+            await update.message.reply_text("❌ Unknown booking link")
+            return ConversationHandler.END
+        await set_user_tenant(context, update.effective_user.id, tenant)
+    tenant = await user_tenant(context, update.effective_user.id)
+    
+    days_config = await get_days_config(tenant)
+    active_days = [day for day in WEEKDAYS if day in days_config and days_config[day]['active']]
     if not active_days:
         await update.message.reply_text("❌ No available days for booking")
         return ConversationHandler.END
 
     buttons = []
     for day in active_days:
-        buttons.append([InlineKeyboardButton(day.capitalize(), callback_data=day)])
+        buttons.append([InlineKeyboardButton(
+            day.capitalize(), callback_data=cb.encode(cb.CHOOSE_DAY, WEEKDAYS.index(day))
+        )])
     
     await update.message.reply_text(
         "Choose a day for your appointment:",
@@ -537,7 +1259,7 @@ async def start(update: Update, context: CallbackContext):
 
 async def choose_day(update: Update, context: CallbackContext):
     query = update.callback_query
-    day = query.data
+    day = callback_day(query)
     context.user_data['day'] = day
     await query.edit_message_text(text=f"Selected {day.capitalize()}\nPlease enter your full name:")
     return GET_NAME
@@ -551,34 +1273,30 @@ async def get_contact(update: Update, context: CallbackContext) -> int:
     context.user_data['contact'] = update.message.text
     return await show_time_slots(update, context)
 
-def generate_slots(day):
-    config = days_config[day]
+def next_occurrence(day):
     today = datetime.today()
-    
-    day_number = 2 if day == 'wednesday' else 4
-    next_day = today + timedelta((day_number - today.weekday()) % 7)
-    
-    start = datetime.strptime(config['start'], "%H:%M")
-    end = datetime.strptime(config['end'], "%H:%M")
-    duration = timedelta(minutes=config['duration'])
-    
-    slots = []
-    current = next_day.replace(
-        hour=start.hour,
-        minute=start.minute,
-        second=0,
-        microsecond=0
-    )
+    return today + timedelta((WEEKDAYS.index(day) - today.weekday()) % 7)
+
+def generate_slots(tenant, day, config):
+    next_day = next_occurrence(day)
     
     # Get all appointments for this specific date
-    start_of_day = next_day.replace(hour=0, minute=0, second=0)
+    start_of_day = next_day.replace(hour=0, minute=0, second=0, microsecond=0)
     end_of_day = next_day.replace(hour=23, minute=59, second=59)
     
     existing_appointments = list(appointments.find({
+        "tenant": tenant,
         "start": {"$gte": start_of_day.isoformat()},
         "end": {"$lte": end_of_day.isoformat()}
     }))
     
+    # Slots currently offered to a waitlisted user are not up for grabs
+    existing_appointments += list(holds.find({
+        "tenant": tenant,
+        "start": {"$gte": start_of_day.isoformat(), "$lte": end_of_day.isoformat()},
+        "expires_at": {"$gt": datetime.now().isoformat()}
+    }))
+    
     # Convert to datetime objects
     booked_slots = []
     for appt in existing_appointments:
@@ -587,64 +1305,32 @@ def generate_slots(day):
             "end": datetime.fromisoformat(appt['end'])
         })
     
-    sorted_breaks = sorted(config['breaks'], key=lambda b: (
-        datetime.strptime(b['start'], "%H:%M").time()
-    ))
+    duration = timedelta(minutes=config['duration'])
+    starts, ends = slot_offsets(config)
     
-    while current.time() < end.time():
-        # Check breaks using sorted_breaks
-        in_break = False
-        for b in sorted_breaks:
-            break_start = datetime.strptime(b['start'], "%H:%M").time()
-            break_end = datetime.strptime(b['end'], "%H:%M").time()
-            
-            if break_start <= current.time() < break_end:
-                current = current.replace(
-                    hour=break_end.hour,
-                    minute=break_end.minute
-                )
-                in_break = True
-                break
-        
-        if in_break:
-            continue
-        
-        slot_end = current + duration
-        remaining_time = datetime.combine(current.date(), end.time()) - current
+    slots = []
+    for start, end in zip(starts.tolist(), ends.tolist()):
+        slot_start = start_of_day + start
+        slot_end = start_of_day + end
         
         # Check for time slot conflicts
-        slot_taken = any(
-            (slot['start'] < slot_end and slot['end'] > current)
+        if not any(
+            (slot['start'] < slot_end and slot['end'] > slot_start)
             for slot in booked_slots
-        )
-        
-        # Regular slot check
-        if slot_end.time() <= end.time():
-            if not slot_taken:
-                slots.append({
-                    'start': current,
-                    'end': slot_end,
-                    'full_duration': True
-                })
-            current = slot_end
-        else:
-            if config['allow_partial_slots'] and remaining_time.total_seconds() > 0:
-                partial_end = current + remaining_time
-                if not any(
-                    (slot['start'] < partial_end and slot['end'] > current)
-                    for slot in booked_slots
-                ):
-                    slots.append({
-                        'start': current,
-                        'end': partial_end,
-                        'full_duration': False
-                    })
-            current += duration
+        ):
+            slots.append({
+                'start': slot_start,
+                'end': slot_end,
+                # Partial slots are cut short by closing time
+                'full_duration': end - start == duration
+            })
             
     return slots
 async def show_time_slots(update: Update, context: CallbackContext):
     day = context.user_data['day']
-    slots = generate_slots(day)
+    tenant = await user_tenant(context, update.effective_user.id)
+    days_config = await get_days_config(tenant)
+    slots = generate_slots(tenant, day, days_config[day])
     
     keyboard = []
 
@@ -653,9 +1339,22 @@ async def show_time_slots(update: Update, context: CallbackContext):
         end_str = slot['end'].strftime("%I:%M %p").lstrip('0')
         keyboard.append([InlineKeyboardButton(
             f"{start_str} - {end_str}",
-            callback_data=slot['start'].isoformat()  # Store start time as identifier
+            callback_data=cb.encode(cb.CHOOSE_SLOT, cb.datetime_to_int(slot['start']))
         )])
     
+    if not slots:
+        date = next_occurrence(day).strftime('%d/%m')
+        await update.message.reply_text(
+            f"😔 {day.capitalize()} {date} is fully booked.\n"
+            "Join the waitlist and we'll offer you the first slot that frees up.",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton(
+                    "📋 Join waitlist", callback_data=cb.encode(cb.JOIN_WAITLIST, WEEKDAYS.index(day))
+                )]
+            ])
+        )
+        return CHOOSE_TIME
+    
     await update.message.reply_text(
         f"Available slots for {day.capitalize()}:",
         reply_markup=InlineKeyboardMarkup(keyboard)
@@ -664,11 +1363,56 @@ async def show_time_slots(update: Update, context: CallbackContext):
 
 async def choose_time(update: Update, context: CallbackContext) -> int:
     query = update.callback_query
-    chosen_start = datetime.fromisoformat(query.data)
+    _, (start,) = cb.decode(query.data)
+    await query.edit_message_text(
+        "🔁 Would you like to repeat this booking every week?",
+        reply_markup=repeat_buttons(start)
+    )
+    return CHOOSE_REPEAT
+
+def repeat_buttons(start):
+    return InlineKeyboardMarkup([[
+        InlineKeyboardButton(
+            "Just once" if weeks == 1 else f"{weeks} weeks",
+            callback_data=cb.encode(cb.CHOOSE_REPEAT, start, weeks)
+        )
+        for weeks in REPEAT_WEEKS
+    ]])
+
+async def choose_repeat(update: Update, context: CallbackContext) -> int:
+    query = update.callback_query
+    _, (start, weeks) = cb.decode(query.data)
+    # Only offered lengths; a forged count would build that many occurrences
+    if weeks not in REPEAT_WEEKS:
+        await query.answer("❌ This button is no longer valid")
+        return CHOOSE_REPEAT
+    chosen_start = cb.int_to_datetime(start)
     day = context.user_data['day']
+    tenant = await user_tenant(context, update.effective_user.id)
+    days_config = await get_days_config(tenant)
     duration = days_config[day]['duration']
     chosen_end = chosen_start + timedelta(minutes=duration)
+    
+    if weeks > 1:
+        occurrences = [
+            {
+                'start': (chosen_start + timedelta(weeks=i)).isoformat(),
+                'end': (chosen_end + timedelta(weeks=i)).isoformat()
+            }
+            for i in range(weeks)
+        ]
+        conflicts = await find_conflicts(tenant, occurrences)
+        if conflicts:
+            taken = conflict_dates(conflicts)
+            await query.edit_message_text(
+                f"❌ This slot is already taken on {taken}.\n"
+                "Please choose fewer weeks:",
+                reply_markup=repeat_buttons(start)
+            )
+            return CHOOSE_REPEAT
+    
     appointments = {
+        'tenant': tenant,
         'day': day,
         'start': chosen_start.isoformat(),
         'end': chosen_end.isoformat(),
@@ -679,75 +1423,285 @@ async def choose_time(update: Update, context: CallbackContext) -> int:
         'user_id': update.effective_user.id,
         'reminder_sent': False
     }
+    if weeks > 1:
+        appointments['occurrences'] = occurrences
+
+    await request_approval(context, appointments)
+    
+    await query.edit_message_text("⌛ Your request has been sent for approval!")
+    return end_session(context, BOOKING_KEYS)
 
-    # Store pending booking in user_data
-    context.user_data['pending_booking'] = appointments
-    result = persistent.insert_one(appointments)
+async def request_approval(context: CallbackContext, booking):
+    result = persistent.insert_one(booking)
+    event_log.record('requested', tenant=booking['tenant'], request_id=result.inserted_id,
+                     booking={k: v for k, v in booking.items() if k != '_id'})
+    request_id = cb.oid_to_int(result.inserted_id)
     
     # Send to admin for approval
     keyboard = [
         [
-            InlineKeyboardButton("✅ Approve", callback_data=f"approve_{update.effective_user.id}"),
-            InlineKeyboardButton("❌ Reject", callback_data=f"reject_{update.effective_user.id}")
+            InlineKeyboardButton("✅ Approve", callback_data=cb.encode(cb.APPROVE, request_id)),
+            InlineKeyboardButton("❌ Reject", callback_data=cb.encode(cb.REJECT, request_id))
         ]
     ]
     
-    await context.bot.send_message(
-        chat_id=ADMIN_CHAT_ID,
-        text=f"New booking request:\n\n"
-             f"Name: {context.user_data['name']}\n"
-             f"Contact: {context.user_data['contact']}\n"
-             f"Day: {day.capitalize()}\n"
-             f"Time: {chosen_start.strftime('%I:%M %p').lstrip('0')} - {chosen_end.strftime('%I:%M %p').lstrip('0')}",
-        reply_markup=InlineKeyboardMarkup(keyboard)
+    # Any of the tenant's admins can answer the request
+    tenant = await get_tenant(booking['tenant'])
+    for admin_id in tenant['admin_ids']:
+        await context.bot.send_message(
+            chat_id=admin_id,
+            text=f"New booking request:\n\n"
+                 f"Name: {booking['name']}\n"
+                 f"Contact: {booking['contact']}\n"
+                 f"Day: {booking['day'].capitalize()}\n"
+                 f"Time: {booking['startf']} - {booking['endf']}" +
+                 series_summary(booking),
+            reply_markup=InlineKeyboardMarkup(keyboard)
+        )
+
+def conflict_dates(conflicts):
+    starts = sorted({c['start'][:10] for c in conflicts})
+    return ", ".join(datetime.fromisoformat(start).strftime('%d/%m') for start in starts)
+
+def series_summary(booking):
+    occurrences = booking.get('occurrences')
+    if not occurrences:
+        return ""
+    first = datetime.fromisoformat(occurrences[0]['start']).strftime('%d/%m')
+    last = datetime.fromisoformat(occurrences[-1]['start']).strftime('%d/%m')
+    return f"\nRepeats: weekly for {len(occurrences)} weeks ({first} - {last})"
+
+# Waitlist
+async def choose_waitlist(update: Update, context: CallbackContext) -> int:
+    query = update.callback_query
+    await query.answer()
+    
+    day = context.user_data['day']
+    next_day = next_occurrence(day)
+    await join_waitlist({
+        'tenant': await user_tenant(context, update.effective_user.id),
+        'user_id': update.effective_user.id,
+        'day': day,
+        'date': next_day.date().isoformat(),
+        'name': context.user_data['name'],
+        'contact': context.user_data['contact']
+    })
+    
+    await query.edit_message_text(
+        f"📋 You're on the waitlist for {day.capitalize()} {next_day.strftime('%d/%m')}.\n"
+        "We'll message you as soon as a slot frees up."
     )
+    return end_session(context, BOOKING_KEYS)
+
+async def offer_freed_slot(context: CallbackContext, slot):
+    """Offer a freed slot to the next user waiting on its date, with a claim hold."""
+    if datetime.fromisoformat(slot['start']) <= datetime.now():
+        return None
+    date = slot['start'][:10]
+    
+    while True:
+        entry = await pop_waitlist(slot['tenant'], date)
+        if not entry:
+            return None
+        
+        start = datetime.fromisoformat(slot['start'])
+        end = datetime.fromisoformat(slot['end'])
+        hold = {
+            'tenant': slot['tenant'],
+            'user_id': entry['user_id'],
+            'day': slot['day'],
+            'start': slot['start'],
+            'end': slot['end'],
+            'startf': start.strftime('%I:%M %p').lstrip('0'),
+            'endf': end.strftime('%I:%M %p').lstrip('0'),
+            'name': entry['name'],
+            'contact': entry['contact'],
+            'expires_at': (datetime.now() + timedelta(minutes=WAITLIST_HOLD_MINUTES)).isoformat()
+        }
+        hold_id = holds.insert_one(hold).inserted_id
+        event_log.record('held', tenant=slot['tenant'], hold_id=hold_id, user_id=entry['user_id'],
+                         start=slot['start'], end=slot['end'])
+        
+        context.job_queue.run_once(
+            expire_hold,
+            WAITLIST_HOLD_MINUTES * 60,
+            data=hold_id,
+            name=f"hold_{hold_id}"
+        )
+        
+        keyboard = [
+            [
+                InlineKeyboardButton("✅ Claim", callback_data=cb.encode(cb.CLAIM, cb.oid_to_int(hold_id))),
+                InlineKeyboardButton("➡️ Pass", callback_data=cb.encode(cb.PASS, cb.oid_to_int(hold_id)))
+            ]
+        ]
+        try:
+            await context.bot.send_message(
+                chat_id=entry['user_id'],
+                text=f"🎉 A slot opened up on {start.strftime('%A %d/%m')} "
+                     f"at {hold['startf']} - {hold['endf']}!\n\n"
+                     f"It's held for you for {WAITLIST_HOLD_MINUTES} minutes.",
+                reply_markup=InlineKeyboardMarkup(keyboard)
+            )
+            return hold_id
+        except Exception as e:
+            # User blocked the bot or similar; move on to the next in line
+            logging.warning(f"Could not offer slot to {entry['user_id']}: {e}")
+            for job in context.job_queue.get_jobs_by_name(f"hold_{hold_id}"):
+                job.schedule_removal()
+            await release_hold(hold_id)
+
+def reschedule_holds(job_queue):
+    """Recreate expiry jobs for holds outstanding when the bot last stopped."""
+    now = datetime.now()
+    for hold in holds.find({}, {"expires_at": 1}):
+        remaining = (datetime.fromisoformat(hold['expires_at']) - now).total_seconds()
+        job_queue.run_once(expire_hold, max(remaining, 0), data=hold['_id'], name=f"hold_{hold['_id']}")
+
+async def expire_hold(context: CallbackContext):
+    hold = await release_hold(context.job.data)
+    if not hold:
+        return  # Already claimed or passed
+    
+    try:
+        await context.bot.send_message(
+            chat_id=hold['user_id'],
+            text="⌛ Your slot offer has expired"
+        )
+    except Exception as e:
+        logging.warning(f"Could not notify {hold['user_id']} of expiry: {e}")
+    await offer_freed_slot(context, hold)
+
+async def handle_claim(update: Update, context: CallbackContext):
+    query = update.callback_query
+    await query.answer()
+    
+    tag, (hold_id,) = cb.decode(query.data)
+    hold_id = cb.int_to_oid(hold_id)
+    
+    if tag == cb.PASS:
+        for job in context.job_queue.get_jobs_by_name(f"hold_{hold_id}"):
+            job.schedule_removal()
+        hold = await release_hold(hold_id)
+        await query.edit_message_text("👍 No problem, we've passed the slot on")
+        if hold:
+            await offer_freed_slot(context, hold)
+        return
     
+    hold = await claim_hold(hold_id, update.effective_user.id)
+    if not hold:
+        # The expiry job still runs and passes the slot on
+        await query.edit_message_text("❌ This offer has expired")
+        return
+    
+    for job in context.job_queue.get_jobs_by_name(f"hold_{hold_id}"):
+        job.schedule_removal()
+    
+    booking = {key: hold[key] for key in ('tenant', 'day', 'start', 'end', 'startf', 'endf', 'name', 'contact', 'user_id')}
+    booking['reminder_sent'] = False
+    await request_approval(context, booking)
     await query.edit_message_text("⌛ Your request has been sent for approval!")
-    return ConversationHandler.END
 
 # Add admin approval handler
 async def handle_admin_approval(update: Update, context: CallbackContext):
+    tag, (request_id,) = cb.decode(update.callback_query.data)
+    return await answer_request(update, context, tag, cb.int_to_oid(request_id))
+
+async def handle_legacy_approval(update: Update, context: CallbackContext):
+    # Buttons sent before callback data was encoded carry approve_/reject_<user id>
+    action, user_id = update.callback_query.data.split('_')
+    request = persistent.find_one({"user_id": int(user_id)}, sort=[("_id", -1)])
+    if not request:
+        await update.callback_query.edit_message_text("❌ Booking request not found")
+        return
+    tag = cb.APPROVE if action == 'approve' else cb.REJECT
+    return await answer_request(update, context, tag, request['_id'])
+
+async def answer_request(update: Update, context: CallbackContext, tag, request_id):
     query = update.callback_query
-    action, user_id = query.data.split('_')
-    user_id = int(user_id)
     
-    # Get pending booking from user_data
-    user_data = await get_user_persistent(user_id=user_id)
-    #pending_booking = user_data.get('pending_booking')
+    # Get pending booking request
+    user_data = await get_persistent(request_id)
     
     if not user_data:
         await query.edit_message_text("❌ Booking request not found")
         return
+    user_id = user_data['user_id']
+    tenant = user_data['tenant']
+    if await admin_tenant(query.from_user.id) != tenant:
+        await query.answer("❌ Admin only command")
+        return
     
-    if action == 'approve':
-        # Save to database
-        appointments.insert_one({
-            'user_id': user_id,
-            'day': user_data['day'],
-            'end': user_data['end'],
-            'start': user_data['start'],
-            'name': user_data['name'],
-            'contact': user_data['contact'],
-            'status': 'confirmed'
-        })
+    if tag == cb.APPROVE:
+        occurrences = user_data.get('occurrences')
+        if occurrences:
+            # Re-check the whole series; slots may have been taken since the request
+            conflicts = await find_conflicts(tenant, occurrences, series_id=request_id)
+            if conflicts:
+                taken = conflict_dates(conflicts)
+                await query.edit_message_text(
+                    f"❌ Cannot approve, series conflicts with bookings on {taken}.\n"
+                    "Reject it so the user can rebook.",
+                    reply_markup=query.message.reply_markup if query.message else None
+                )
+                return
+            
+            bookings = [{
+                'tenant': tenant,
+                'user_id': user_id,
+                'day': user_data['day'],
+                'end': o['end'],
+                'start': o['start'],
+                'name': user_data['name'],
+                'contact': user_data['contact'],
+                'status': 'confirmed',
+                'series_id': request_id
+            } for o in occurrences]
+            try:
+                await create_series(bookings, request_id)
+            except PyMongoError as e:
+                logging.error(f"Could not create series {request_id}: {e}")
+                await query.edit_message_text(
+                    "❌ Could not save the series. Please try approving again.",
+                    reply_markup=query.message.reply_markup if query.message else None
+                )
+                return
+        else:
+            # Save to database
+            bookings = [{
+                'tenant': tenant,
+                'user_id': user_id,
+                'day': user_data['day'],
+                'end': user_data['end'],
+                'start': user_data['start'],
+                'name': user_data['name'],
+                'contact': user_data['contact'],
+                'status': 'confirmed'
+            }]
+            appointments.insert_one(bookings[0])
+        event_log.record('approved', tenant=tenant, request_id=request_id, user_id=user_id, appointments=bookings)
+        for booking in bookings:
+            await update_rollup(booking, approvals=1)
         
         # Notify user
         await context.bot.send_message(
             chat_id=user_id,
             text=f"✅ Your booking for {user_data['day'].capitalize()} "
-                 f"at {user_data['startf']} has been confirmed!"
+                 f"at {user_data['startf']} has been confirmed!" +
+                 series_summary(user_data)
         )
         await query.edit_message_text(f"✅ Booking approved!\n\n"
                                       f"Name: {user_data['name']}\n"
                                       f"Contact: {user_data['contact']}\n"
                                       f"Day: {user_data['day']}\n"
-                                      f"Time: {user_data['startf']} - {user_data['endf']}")
+                                      f"Time: {user_data['startf']} - {user_data['endf']}" +
+                                      series_summary(user_data))
         # Clear pending booking
-        await delete_persistent(user_id=user_id)
+        await delete_persistent(request_id)
         
     else:
         # Store rejection context in admin's user_data
-        context.user_data['rejecting_user'] = user_id
+        context.user_data['rejecting_request'] = request_id
     
         
         await query.edit_message_text("📝 Please enter the rejection reason:")
@@ -756,9 +1710,10 @@ async def handle_admin_approval(update: Update, context: CallbackContext):
 
 async def rejection_reason(update: Update, context: CallbackContext):
     reason = update.message.text
-    print(reason)
-    user_id = context.user_data['rejecting_user']
-    user_data = await get_user_persistent(user_id=user_id)
+    request_id = context.user_data['rejecting_request']
+    user_data = await get_persistent(request_id)
+    user_id = user_data['user_id']
+    event_log.record('rejected', tenant=user_data['tenant'], request_id=request_id, user_id=user_id, reason=reason)
     
     # Notify user
     await context.bot.send_message(
@@ -768,14 +1723,15 @@ async def rejection_reason(update: Update, context: CallbackContext):
         )
     
     # Clear pending booking
-    await delete_persistent(user_id=user_id)
+    await delete_persistent(request_id)
+    await update_rollup(user_data, rejections=1)
     
     await update.message.reply_text(f"❌ Booking rejected!\n\n"
                                       f"Name: {user_data['name']}\n"
                                       f"Contact: {user_data['contact']}\n"
                                       f"Day: {user_data['day']}\n"
                                       f"Time: {user_data['startf']} - {user_data['endf']}")
-    return ConversationHandler.END
+    return end_session(context, REJECTION_KEYS)
 
 
 
@@ -827,7 +1783,7 @@ async def confirm_booking(update: Update, context: CallbackContext):
 async def send_reminder(context: CallbackContext):
     job = context.job
     user_id = job.user_id
-    appointment = get_user_appointments(user_id)
+    appointment = await get_user_appointments(user_id)
     
     if appointment:
         start = datetime.fromisoformat(appointment['start'])
@@ -840,40 +1796,268 @@ async def send_reminder(context: CallbackContext):
         )
         await context.bot.send_message(chat_id=user_id, text=reminder_text)
 
-async def cancel(update: Update, context: CallbackContext):
+async def cancel(update: Update, context: CallbackContext, keys):
     await update.message.reply_text("❌ Booking cancelled", reply_markup=ReplyKeyboardRemove())
+    return end_session(context, keys)
+
+
+# Update recording
+# Free text is replaced unless it is a bare number/time that admin flows
+# depend on (durations, break times); commands are handled word by word
+KEEP_TEXT = re.compile(r"^(\d{1,4}|\d{1,2}:\d{2})$")
+COMMAND = re.compile(r"^/\w+(@\w+)?$")
+# Command arguments kept as is (tenant ids, dates, formats, small numbers)
+KEEP_ARG = re.compile(r"^[A-Za-z0-9_:.-]{1,64}$")
+# Arguments that look like Telegram ids, hashed like every other id
+ID_ARG = re.compile(r"^-?\d{5,}$")
+PERSONAL_FIELDS = {'first_name', 'last_name', 'username', 'title', 'phone_number', 'bio'}
+
+def anonymize_id(value):
+    digest = hashlib.sha256(f"{RECORD_SALT}{value}".encode()).hexdigest()
+    anon = int(digest[:12], 16)
+    # Keep the sign so group chats still look like group chats
+    return -anon if int(value) < 0 else anon
+
+def anonymize_text(text):
+    if KEEP_TEXT.match(text):
+        return text
+    command, *args = text.split() or [""]
+    if not COMMAND.match(command):
+        return "redacted"
+    return " ".join([command] + [
+        str(anonymize_id(arg)) if ID_ARG.match(arg) else arg if KEEP_ARG.match(arg) else "redacted"
+        for arg in args
+    ])
+
+def anonymize(data):
+    if isinstance(data, list):
+        return [anonymize(item) for item in data]
+    if not isinstance(data, dict):
+        return data
+    
+    result = {}
+    for key, value in data.items():
+        if key in PERSONAL_FIELDS:
+            result[key] = "redacted"
+        elif key in ('user_id', 'chat_id') and isinstance(value, int):
+            result[key] = anonymize_id(value)
+        elif key in ('text', 'caption') and isinstance(value, str):
+            result[key] = anonymize_text(value)
+        elif key in ('from', 'chat', 'user', 'sender_chat') and isinstance(value, dict):
+            result[key] = {**anonymize(value), 'id': anonymize_id(value['id'])}
+        else:
+            result[key] = anonymize(value)
+    return result
+
+class UpdateRecorder:
+    """Append anonymized updates with their arrival time to a gzip'd JSON lines log."""
+    
+    def __init__(self, path):
+        new_file = not os.path.exists(path)
+        self.file = gzip.open(path, 'at', encoding='utf-8')
+        if new_file:
+            # Lets replay.py recreate the tenants and recognise their admins after ids are hashed
+            tenants = [
+                {'_id': doc['_id'], 'days_config': doc['days_config'],
+                 'admin_ids': [str(anonymize_id(admin_id)) for admin_id in doc.get('admin_ids', [])]}
+                for doc in slots_config.find({}, {'days_config': 1, 'admin_ids': 1})
+            ]
+            self.file.write(json.dumps({'admin_chat_id': anonymize_id(ADMIN_CHAT_ID or 0), 'tenants': tenants}) + "\n")
+        atexit.register(self.close)
+    
+    async def __call__(self, update: Update, context: CallbackContext):
+        self.file.write(json.dumps({'t': time.time(), 'update': anonymize(update.to_dict())}) + "\n")
+    
+    def close(self):
+        if not self.file.closed:
+            self.file.close()
+
+# Idle sessions
+# user_data keys of each conversation, cleared when it ends so other flows the user
+# has open keep theirs; 'tenant' stays until the sweeper drops the user, after which
+# user_tenant() reloads it from Mongo
+BOOKING_KEYS = ('day', 'name', 'contact')
+DURATION_KEYS = ('duration_day', 'pending_change')
+BREAK_KEYS = ('break_day', 'break_start', 'pending_change')
+REMOVE_BREAK_KEYS = ('remove_break_day',)
+PARTIAL_KEYS = ('pending_change',)
+REJECTION_KEYS = ('rejecting_request',)
+# user id -> monotonic time of their last update, least recently seen first
+last_seen = OrderedDict()
+session_metrics = {'user_data': 0, 'evicted': 0, 'timeouts': 0}
+
+def end_session(context, keys):
+    for key in keys:
+        context.user_data.pop(key, None)
     return ConversationHandler.END
 
+async def session_timeout(update: Update, context: CallbackContext, keys):
+    session_metrics['timeouts'] += 1
+    end_session(context, keys)
+
+async def touch_session(update: Update, context: CallbackContext):
+    if update.effective_user:
+        last_seen[update.effective_user.id] = time.monotonic()
+        last_seen.move_to_end(update.effective_user.id)
+
+async def sweep_sessions(context: CallbackContext):
+    """Drop user_data of idle users, then of the least recently seen above USER_DATA_MAX."""
+    now = time.monotonic()
+    idle_cutoff = now - SESSION_IDLE_SECONDS
+    # Users seen within CONVERSATION_TIMEOUT may be mid-conversation, so they are
+    # kept even above the cap
+    active_cutoff = now - CONVERSATION_TIMEOUT
+    while last_seen:
+        user_id, seen = next(iter(last_seen.items()))
+        if seen > active_cutoff or (seen > idle_cutoff and len(last_seen) <= USER_DATA_MAX):
+            break
+        last_seen.popitem(last=False)
+        context.application.drop_user_data(user_id)
+        session_metrics['evicted'] += 1
+    
+    session_metrics['user_data'] = len(context.application.user_data)
+    logging.info(f"Sessions: {session_metrics['user_data']} resident, "
+                 f"{session_metrics['evicted']} evicted, RSS {rss_bytes() / 2**20:.1f} MiB")
+
+def rss_bytes():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        # No procfs (e.g. macOS), fall back to peak RSS which is in bytes there
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+# Shutdown
+shutdown_metrics = {'draining': 0, 'last_drain_seconds': 0.0, 'last_drain_timed_out': 0}
+
+def load_last_drain():
+    last = shutdowns.find_one(sort=[("_id", -1)])
+    if last:
+        shutdown_metrics['last_drain_seconds'] = last['drain_seconds']
+        shutdown_metrics['last_drain_timed_out'] = int(last['timed_out'])
+
+async def post_stop(application):
+    await event_log.flush()
+
+async def drain(application):
+    """Stop fetching updates and let queued and in-flight ones finish, up to DRAIN_TIMEOUT."""
+    shutdown_metrics['draining'] = 1
+    started = time.monotonic()
+    
+    # Stops getUpdates first, so the next deployment can start polling right away
+    if application.updater.running:
+        await application.updater.stop()
+    timed_out = False
+    try:
+        await asyncio.wait_for(application.stop(), DRAIN_TIMEOUT)
+    except asyncio.TimeoutError:
+        timed_out = True
+        logging.warning(f"Drain deadline of {DRAIN_TIMEOUT}s hit, abandoning unfinished updates")
+        # stop() was cut short, so jobs and handlers may still be running; end them
+        # here so nothing records events after the final flush
+        await application.job_queue.stop(wait=False)
+        leftover = asyncio.all_tasks() - {asyncio.current_task()}
+        for task in leftover:
+            task.cancel()
+        if leftover:
+            await asyncio.wait(leftover, timeout=5)
+    
+    seconds = time.monotonic() - started
+    logging.info(f"Drained in {seconds:.2f}s")
+    try:
+        shutdowns.insert_one({"at": datetime.now().isoformat(), "drain_seconds": seconds, "timed_out": timed_out})
+    except PyMongoError as e:
+        logging.error(f"Failed to record drain time: {e}")
+
+async def serve():
+    application = build_application()
+    load_last_drain()
+    server = start_web_server()
+    
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stopping.set)
+    
+    await application.initialize()
+    try:
+        await application.updater.start_polling()
+        await application.start()
+        await stopping.wait()
+        
+        await drain(application)
+    finally:
+        if application.running:
+            await application.stop()
+        # Buffered event log writes
+        await post_stop(application)
+        await application.shutdown()
+        await asyncio.to_thread(server.shutdown)
+        client.close()
 
 # Modified main function
-def main():
-    # Set up persistence
-    application = ApplicationBuilder().token(TOKEN).build()
+def build_application(builder=None):
+    if builder is None:
+        # Same pool size ApplicationBuilder gives its default request
+        builder = ApplicationBuilder().token(TOKEN).request(tracing.TracedRequest(connection_pool_size=256))
+    # Root span per update when TRACING is set
+    application = builder.application_class(tracing.TracedApplication).build()
+    ensure_indexes()
+    migrate_default_tenant()
+    backfill_rollups()
+
+    # Booking events are written in batches off the hot path, and once more on stop
+    application.job_queue.run_repeating(flush_events, EVENT_FLUSH_SECONDS, name="flush_events")
+    application.post_stop = post_stop
+
+    # Expiry jobs live in memory only
+    reschedule_holds(application.job_queue)
+    application.job_queue.run_repeating(sweep_sessions, SESSION_SWEEP_SECONDS, name="sweep_sessions")
+    application.add_handler(TypeHandler(Update, touch_session), group=-2)
+
+    if RECORD_UPDATES_FILE:
+        application.add_handler(TypeHandler(Update, UpdateRecorder(RECORD_UPDATES_FILE)), group=-1)
+
+    # Callbacks outside conversations go through a single dispatch table
+    router = cb.CallbackRouter()
+    router.add(cb.CLAIM, handle_claim)
+    router.add(cb.PASS, handle_claim)
+    router.add(cb.TOGGLE_DAY, handle_toggle)
+    router.add(cb.ADMIN_CANCEL, handle_admin_cancel)
+    router.add(cb.ADMIN_CANCEL_ALL, handle_admin_cancel)
 
     # Admin handlers
     application.add_handler(CommandHandler('toggle_days', toggle_day))
     application.add_handler(CommandHandler('cancel_booking', cancel_booking_admin))
-    application.add_handler(CallbackQueryHandler(handle_toggle, pattern=r"^toggle_"))
-    application.add_handler(CallbackQueryHandler(handle_admin_cancel, pattern=r"^cancel_"))
     application.add_handler(CommandHandler('cancel_bookings', admin_cancel_booking))
-    application.add_handler(CallbackQueryHandler(handle_admin_cancel, pattern=r"^admincancel_"))
+    application.add_handler(CommandHandler('stats', stats))
+    application.add_handler(CommandHandler('export', export_bookings))
+    application.add_handler(CommandHandler('rebuild_appointments', rebuild_appointments_admin))
+    application.add_handler(CommandHandler('add_tenant', add_tenant))
     duration_handler = ConversationHandler(
         entry_points=[CommandHandler('set_duration', set_duration)],
         states={
-            SET_DURATION_DAY: [CallbackQueryHandler(set_duration_day)],
-            SET_DURATION_VALUE: [MessageHandler(filters.TEXT & ~filters.COMMAND, set_duration_value)]
+            ConversationHandler.TIMEOUT: [TypeHandler(Update, partial(session_timeout, keys=DURATION_KEYS))],
+            SET_DURATION_DAY: [CallbackQueryHandler(set_duration_day, pattern=cb.matches(cb.DURATION_DAY))],
+            SET_DURATION_VALUE: [MessageHandler(filters.TEXT & ~filters.COMMAND, set_duration_value)],
+            CONFIRM_CHANGE: [CallbackQueryHandler(partial(confirm_change, keys=DURATION_KEYS), pattern=cb.matches(cb.CONFIRM_CHANGE))]
         },
-        fallbacks=[CommandHandler('cancel', cancel)]
+        fallbacks=[CommandHandler('cancel', partial(cancel, keys=DURATION_KEYS))],
+        conversation_timeout=CONVERSATION_TIMEOUT
     )
 
     break_handler = ConversationHandler(
         entry_points=[CommandHandler('add_break', add_break)],
         states={
-            ADD_BREAK_DAY: [CallbackQueryHandler(add_break_day)],
+            ConversationHandler.TIMEOUT: [TypeHandler(Update, partial(session_timeout, keys=BREAK_KEYS))],
+            ADD_BREAK_DAY: [CallbackQueryHandler(add_break_day, pattern=cb.matches(cb.BREAK_DAY))],
             ADD_BREAK_START: [MessageHandler(filters.TEXT & ~filters.COMMAND, add_break_start)],
-            ADD_BREAK_END: [MessageHandler(filters.TEXT & ~filters.COMMAND, add_break_end)]
+            ADD_BREAK_END: [MessageHandler(filters.TEXT & ~filters.COMMAND, add_break_end)],
+            CONFIRM_CHANGE: [CallbackQueryHandler(partial(confirm_change, keys=BREAK_KEYS), pattern=cb.matches(cb.CONFIRM_CHANGE))]
         },
-        fallbacks=[CommandHandler('cancel', cancel)]
+        fallbacks=[CommandHandler('cancel', partial(cancel, keys=BREAK_KEYS))],
+        conversation_timeout=CONVERSATION_TIMEOUT
     )
 
     application.add_handler(duration_handler)
@@ -882,23 +2066,32 @@ def main():
     remove_break_handler = ConversationHandler(
     entry_points=[CommandHandler('remove_break', remove_break)],
     states={
-        REMOVE_BREAK_DAY: [CallbackQueryHandler(remove_break_day, pattern=r"^removebreak_")],
-        SELECT_BREAK_TO_REMOVE: [CallbackQueryHandler(handle_break_removal, pattern=r"^removebreak_")]
+        ConversationHandler.TIMEOUT: [TypeHandler(Update, partial(session_timeout, keys=REMOVE_BREAK_KEYS))],
+        REMOVE_BREAK_DAY: [CallbackQueryHandler(remove_break_day, pattern=cb.matches(cb.REMOVE_BREAK_DAY))],
+        SELECT_BREAK_TO_REMOVE: [CallbackQueryHandler(
+            handle_break_removal, pattern=cb.matches(cb.REMOVE_BREAK, cb.REMOVE_ALL_BREAKS)
+        )]
     },
-    fallbacks=[CommandHandler('cancel', cancel)]
+    fallbacks=[CommandHandler('cancel', partial(cancel, keys=REMOVE_BREAK_KEYS))],
+    conversation_timeout=CONVERSATION_TIMEOUT
     )
 
     application.add_handler(remove_break_handler)
     # Add admin approval handler
     admin_conv = ConversationHandler(
-        entry_points=[CallbackQueryHandler(handle_admin_approval, pattern=r"^(approve|reject)_")],
+        entry_points=[
+            CallbackQueryHandler(handle_admin_approval, pattern=cb.matches(cb.APPROVE, cb.REJECT)),
+            CallbackQueryHandler(handle_legacy_approval, pattern=r"^(approve|reject)_\d+$")
+        ],
         states={
+            ConversationHandler.TIMEOUT: [TypeHandler(Update, partial(session_timeout, keys=REJECTION_KEYS))],
             REJECTION_REASON: [MessageHandler(
                 filters.TEXT & ~filters.COMMAND,
                 rejection_reason
             )]
         },
-        fallbacks=[CommandHandler('cancel', cancel)],
+        fallbacks=[CommandHandler('cancel', partial(cancel, keys=REJECTION_KEYS))],
+        conversation_timeout=CONVERSATION_TIMEOUT,
         per_user=True,
         per_chat=False
         
@@ -910,29 +2103,39 @@ def main():
     conv_handler = ConversationHandler(
         entry_points=[CommandHandler('start', start)],
         states={
-            CHOOSE_DAY: [CallbackQueryHandler(choose_day)],
+            ConversationHandler.TIMEOUT: [TypeHandler(Update, partial(session_timeout, keys=BOOKING_KEYS))],
+            CHOOSE_DAY: [CallbackQueryHandler(choose_day, pattern=cb.matches(cb.CHOOSE_DAY))],
             GET_NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_name)],
             GET_CONTACT: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_contact)],
-            CHOOSE_TIME: [CallbackQueryHandler(choose_time)]
+            CHOOSE_TIME: [
+                CallbackQueryHandler(choose_waitlist, pattern=cb.matches(cb.JOIN_WAITLIST)),
+                CallbackQueryHandler(choose_time, pattern=cb.matches(cb.CHOOSE_SLOT))
+            ],
+            CHOOSE_REPEAT: [CallbackQueryHandler(choose_repeat, pattern=cb.matches(cb.CHOOSE_REPEAT))]
         },
-        fallbacks=[CommandHandler('cancel', cancel)]
+        fallbacks=[CommandHandler('cancel', partial(cancel, keys=BOOKING_KEYS))],
+        conversation_timeout=CONVERSATION_TIMEOUT
     )
     partial_handler = ConversationHandler(
     entry_points=[CommandHandler('partial_slots', toggle_partial_slots)],
     states={
-        TOGGLE_PARTIAL_DAY: [CallbackQueryHandler(set_partial_mode, pattern=r"^partial_")],
-        SET_PARTIAL_MODE: [CallbackQueryHandler(handle_partial_toggle, pattern=r"^partial(en|dis)able_")]
+        ConversationHandler.TIMEOUT: [TypeHandler(Update, partial(session_timeout, keys=PARTIAL_KEYS))],
+        TOGGLE_PARTIAL_DAY: [CallbackQueryHandler(set_partial_mode, pattern=cb.matches(cb.PARTIAL_DAY))],
+        SET_PARTIAL_MODE: [CallbackQueryHandler(handle_partial_toggle, pattern=cb.matches(cb.PARTIAL_MODE))],
+        CONFIRM_CHANGE: [CallbackQueryHandler(partial(confirm_change, keys=PARTIAL_KEYS), pattern=cb.matches(cb.CONFIRM_CHANGE))]
     },
-    fallbacks=[CommandHandler('cancel', cancel)]
+    fallbacks=[CommandHandler('cancel', partial(cancel, keys=PARTIAL_KEYS))],
+    conversation_timeout=CONVERSATION_TIMEOUT
     )
     application.add_handler(partial_handler)
 
     application.add_handler(conv_handler)
-    application.run_polling()
+    application.add_handler(CallbackQueryHandler(router.dispatch))
+    return application
+
+def main():
+    asyncio.run(serve())
 
 if __name__ == '__main__':
-    # Start the web server in a new thread
-    web_thread = threading.Thread(target=run_web_server)
-    web_thread.start()
     main()
     
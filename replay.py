@@ -0,0 +1,226 @@
+"""Replay a recorded update log against the bot for performance testing.
+
+Record production traffic by starting the bot with RECORD_UPDATES=updates.jsonl.gz,
+then replay it against a local throwaway Mongo database and a stand-in for
+the Telegram Bot API:
+
+    python replay.py updates.jsonl.gz --speed 10 --db booking_replay
+
+The replayed handlers write to the target database, so it must be on
+localhost and must not be the DB_NAME the bot is configured with.
+
+Reports per-handler latency and Mongo commands per call.
+"""
+import argparse
+import asyncio
+import contextvars
+import gzip
+import itertools
+import json
+import os
+import sys
+import time
+from collections import defaultdict
+
+from dotenv import dotenv_values
+from pymongo import monitoring, uri_parser
+from telegram import Update
+from telegram.ext import ApplicationBuilder, ConversationHandler
+from telegram.request import BaseRequest
+
+current_handler = contextvars.ContextVar('current_handler', default=None)
+mongo_commands = defaultdict(int)
+latencies = defaultdict(list)
+
+
+class CommandCounter(monitoring.CommandListener):
+    def started(self, event):
+        mongo_commands[current_handler.get()] += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+# Must be registered before booking creates its MongoClient
+monitoring.register(CommandCounter())
+
+# Imported in main() once the target database is checked
+booking = None
+
+LOCAL_HOSTS = ('localhost', '127.0.0.1', '::1')
+
+
+class FakeTelegramRequest(BaseRequest):
+    """Answers every Bot API call locally, optionally after a fixed latency."""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.message_id = 0
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        endpoint = url.rsplit('/', 1)[-1]
+        params = request_data.parameters if request_data else {}
+        if endpoint == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'Replay', 'username': 'replay_bot'}
+        elif endpoint in ('sendMessage', 'editMessageText', 'sendDocument'):
+            self.message_id += 1
+            result = {
+                'message_id': self.message_id,
+                'date': int(time.time()),
+                'chat': {'id': params.get('chat_id') or 0, 'type': 'private'},
+            }
+        else:
+            result = True
+        return 200, json.dumps({'ok': True, 'result': result}).encode()
+
+
+def timed(name, callback):
+    async def wrapper(update, context):
+        token = current_handler.set(name)
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        finally:
+            latencies[name].append(time.perf_counter() - started)
+            current_handler.reset(token)
+    return wrapper
+
+
+def instrument(handlers):
+    for handler in handlers:
+        if isinstance(handler, ConversationHandler):
+            instrument(handler.entry_points)
+            for state_handlers in handler.states.values():
+                instrument(state_handlers)
+            instrument(handler.fallbacks)
+        else:
+            # Per-conversation callbacks are partials of the shared handler
+            callback = getattr(handler.callback, 'func', handler.callback)
+            name = getattr(callback, '__qualname__', type(callback).__name__)
+            handler.callback = timed(name, handler.callback)
+
+
+def read_log(path):
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        try:
+            for line in f:
+                yield json.loads(line)
+        except (EOFError, json.JSONDecodeError):
+            # The recorder was killed mid-write; keep what was complete
+            return
+
+
+def check_target(mongo_uri, db_name):
+    """Return why replaying into this database is refused, or None if it is safe."""
+    configured = {**dotenv_values(), **os.environ}
+    try:
+        hosts = [host for host, _ in uri_parser.parse_uri(mongo_uri)['nodelist']]
+    except Exception as e:
+        return f"invalid --mongo-uri: {e}"
+    if not hosts or any(host not in LOCAL_HOSTS for host in hosts):
+        return f"{', '.join(hosts) or mongo_uri} is not local"
+    if db_name == configured.get('DB_NAME'):
+        return f"{db_name} is the bot's configured DB_NAME"
+    return None
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct))]
+
+
+async def replay(path, speed, api_latency):
+    records = read_log(path)
+    header = next(records, {})
+    if 'admin_chat_id' in header:
+        # Read before build_application, which makes this chat the default tenant's admin
+        booking.ADMIN_CHAT_ID = str(header['admin_chat_id'])
+        # Tenants as they were when recording started; later ones are added by the replayed /add_tenant
+        for tenant in header.get('tenants', []):
+            booking.slots_config.replace_one({"_id": tenant['_id']}, tenant, upsert=True)
+        header = None
+
+    request = FakeTelegramRequest(api_latency)
+    builder = (ApplicationBuilder().token('0:replay')
+               .request(request).get_updates_request(FakeTelegramRequest())
+               .updater(None))
+    # Never re-record the replayed traffic
+    booking.RECORD_UPDATES_FILE = None
+    application = booking.build_application(builder)
+    for handlers in application.handlers.values():
+        instrument(handlers)
+
+    await application.initialize()
+    await application.start()
+
+    count = 0
+    first = None
+    started = time.perf_counter()
+    for record in itertools.chain([header] if header else [], records):
+        if first is None:
+            first = record['t']
+        # Keep the recorded inter-arrival gaps, compressed by speed
+        delay = (record['t'] - first) / speed - (time.perf_counter() - started)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        await application.update_queue.put(Update.de_json(record['update'], application.bot))
+        count += 1
+
+    # Wait for every queued update to be handled
+    await application.update_queue.join()
+    elapsed = time.perf_counter() - started
+    await application.stop()
+    await application.shutdown()
+    return count, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('log', help="update log written with RECORD_UPDATES")
+    parser.add_argument('--speed', type=float, default=1.0, help="replay speed multiplier (default 1x)")
+    parser.add_argument('--api-latency', type=float, default=0.0,
+                        help="simulated Bot API latency in milliseconds")
+    parser.add_argument('--mongo-uri', default='mongodb://localhost:27017',
+                        help="local Mongo to replay into (default mongodb://localhost:27017)")
+    parser.add_argument('--db', default='booking_replay',
+                        help="throwaway database, dropped first (default booking_replay)")
+    args = parser.parse_args()
+
+    problem = check_target(args.mongo_uri, args.db)
+    if problem:
+        sys.exit(f"Refusing to replay: {problem}")
+    # Set before booking connects at import; load_dotenv() does not override them
+    os.environ['MONGODB_URI'] = args.mongo_uri
+    os.environ['DB_NAME'] = args.db
+    global booking
+    import booking
+    # Start from an empty database so runs are comparable
+    booking.client.drop_database(args.db)
+
+    count, elapsed = asyncio.run(replay(args.log, args.speed, args.api_latency / 1000))
+
+    print(f"Replayed {count} updates in {elapsed:.1f}s at {args.speed:g}x\n")
+    print(f"{'handler':32} {'calls':>6} {'p50 ms':>8} {'p95 ms':>8} {'max ms':>8} {'mongo/call':>10}")
+    for name, values in sorted(latencies.items(), key=lambda item: -sum(item[1])):
+        print(f"{name:32} {len(values):6} {percentile(values, 0.5) * 1000:8.1f} "
+              f"{percentile(values, 0.95) * 1000:8.1f} {max(values) * 1000:8.1f} "
+              f"{mongo_commands[name] / len(values):10.1f}")
+    if mongo_commands[None]:
+        print(f"\n{mongo_commands[None]} Mongo commands outside handlers (indexes, jobs)")
+
+
+if __name__ == '__main__':
+    main()
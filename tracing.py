@@ -0,0 +1,174 @@
+"""Optional OpenTelemetry tracing for the bot.
+
+Each update gets a root span, with child spans for every Mongo command
+(pymongo command monitoring) and Bot API request made while handling it.
+
+    TRACING=otlp               export to a collector, see OTEL_EXPORTER_OTLP_ENDPOINT
+                               (default http://localhost:4318)
+    TRACING=file:traces.jsonl  append finished spans as JSON lines
+    TRACE_SAMPLE_RATIO=0.05    keep 5% of updates (default 1); children follow their root
+    LOG_FORMAT=json            JSON log lines carrying trace_id and span_id
+
+Needs opentelemetry-sdk, plus opentelemetry-exporter-otlp-proto-http for otlp.
+With TRACING unset or the SDK missing, nothing here records anything.
+"""
+import json
+import logging
+import os
+import time
+
+from pymongo import monitoring
+from telegram import Update
+from telegram.ext import Application
+from telegram.request import HTTPXRequest
+
+try:
+    from opentelemetry import trace
+    from opentelemetry.sdk.resources import Resource
+    from opentelemetry.sdk.trace import TracerProvider
+    from opentelemetry.sdk.trace.export import BatchSpanProcessor, ConsoleSpanExporter
+    from opentelemetry.sdk.trace.sampling import ParentBased, TraceIdRatioBased
+    from opentelemetry.trace import SpanKind, Status, StatusCode
+except ImportError:
+    trace = None
+
+SERVICE_NAME = 'telegram-booking-bot'
+
+tracer = None
+
+
+def setup():
+    """Install the tracer provider from the environment; returns True if tracing is on."""
+    global tracer
+    exporter_name = os.getenv('TRACING')
+    if not exporter_name:
+        return False
+    if trace is None:
+        logging.warning("TRACING is set but opentelemetry-sdk is not installed, tracing is off")
+        return False
+
+    if exporter_name == 'otlp':
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+        exporter = OTLPSpanExporter()
+    elif exporter_name.startswith('file:'):
+        out = open(exporter_name[len('file:'):], 'a', encoding='utf-8')
+        exporter = ConsoleSpanExporter(out=out, formatter=lambda span: span.to_json(indent=None) + "\n")
+    else:
+        raise ValueError(f"Unknown TRACING exporter: {exporter_name!r}")
+
+    # Sampling is decided once per update; Mongo and Bot API spans follow their parent
+    ratio = float(os.getenv('TRACE_SAMPLE_RATIO', 1.0))
+    provider = TracerProvider(
+        resource=Resource.create({'service.name': SERVICE_NAME}),
+        sampler=ParentBased(TraceIdRatioBased(ratio))
+    )
+    provider.add_span_processor(BatchSpanProcessor(exporter))
+    trace.set_tracer_provider(provider)
+    tracer = trace.get_tracer(SERVICE_NAME)
+    return True
+
+
+def update_attributes(update):
+    attributes = {'telegram.update_id': update.update_id}
+    message = update.effective_message
+    if update.callback_query:
+        attributes['telegram.update_type'] = 'callback_query'
+        # Only the type tag; the fields carry ids
+        attributes['telegram.callback_tag'] = (update.callback_query.data or '')[:1]
+    elif message:
+        attributes['telegram.update_type'] = 'message'
+        if message.text and message.text.startswith('/'):
+            attributes['telegram.command'] = message.text.split()[0]
+    if update.message and update.message.date:
+        # Only new messages: an edited or callback message's date is when it was first sent.
+        # Whole seconds only, but enough to spot updates that sat in a queue
+        attributes['telegram.update_age_s'] = max(0.0, time.time() - update.message.date.timestamp())
+    return attributes
+
+
+class TracedApplication(Application):
+    """Application that handles every update inside a root span."""
+
+    async def process_update(self, update):
+        if tracer is None or not isinstance(update, Update):
+            return await super().process_update(update)
+        with tracer.start_as_current_span('update', kind=SpanKind.SERVER,
+                                          attributes=update_attributes(update)):
+            return await super().process_update(update)
+
+
+class TracedRequest(HTTPXRequest):
+    """HTTPXRequest recording a span per Bot API call, named by method only (the URL holds the token)."""
+
+    async def do_request(self, url, method, *args, **kwargs):
+        if tracer is None:
+            return await super().do_request(url, method, *args, **kwargs)
+        api_method = url.rsplit('/', 1)[-1]
+        with tracer.start_as_current_span(f"telegram {api_method}", kind=SpanKind.CLIENT,
+                                          attributes={'rpc.method': api_method}) as span:
+            code, payload = await super().do_request(url, method, *args, **kwargs)
+            span.set_attribute('http.response.status_code', code)
+            return code, payload
+
+
+class MongoSpans(monitoring.CommandListener):
+    """Span per Mongo command, parented by the span current in the calling thread."""
+
+    def __init__(self):
+        self.spans = {}
+
+    def started(self, event):
+        attributes = {
+            'db.system': 'mongodb',
+            'db.name': event.database_name,
+            'db.operation': event.command_name,
+        }
+        # Collection name only; filters and documents may hold personal data
+        collection = event.command.get(event.command_name)
+        if isinstance(collection, str):
+            attributes['db.mongodb.collection'] = collection
+        span = tracer.start_span(f"mongo {event.command_name}", kind=SpanKind.CLIENT, attributes=attributes)
+        self.spans[(event.connection_id, event.request_id)] = span
+
+    def succeeded(self, event):
+        span = self.spans.pop((event.connection_id, event.request_id), None)
+        if span:
+            span.end()
+
+    def failed(self, event):
+        span = self.spans.pop((event.connection_id, event.request_id), None)
+        if span:
+            span.set_status(Status(StatusCode.ERROR, str(event.failure)))
+            span.end()
+
+
+def mongo_listeners():
+    return [MongoSpans()] if tracer else []
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        if trace is not None:
+            # Set for unsampled updates too, so their logs still group by update
+            context = trace.get_current_span().get_span_context()
+            if context.is_valid:
+                entry['trace_id'] = format(context.trace_id, '032x')
+                entry['span_id'] = format(context.span_id, '016x')
+        if record.exc_info:
+            entry['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+def log_handlers():
+    """Handlers for logging.basicConfig; None keeps the default text output."""
+    if os.getenv('LOG_FORMAT', 'text') != 'json':
+        return None
+    handler = logging.StreamHandler()
+    handler.setFormatter(JsonFormatter())
+    return [handler]